@@ -19,6 +19,7 @@ from pymongo.command_cursor import CommandCursor
 from datetime import datetime
 
 from part1.db import DBC
+from part1.dates import get_period, get_calendar_fields, PERIOD_FIELDS
 from part1.download import ensure_folder, DATA_PATH
 from part1.ciselniky import ORP, Kraje, OBYVATELSTVO_KRAJ_CSU7700
 from part1.invalid_orp import InvalidORPCodeDetector
@@ -35,6 +36,26 @@ class CSVCreator():
 
     FIRST_QUARTER_DATE = DateParser.parse('2020-10-01')
 
+    # collections read by the queries
+    QUERY_COLLECTIONS = [
+        'covid_po_dnech_cr',
+        'nakazeni_vek_okres_kraj',
+        'nakazeni_vyleceni_umrti_testy_kraj',
+        'obyvatelstvo_kraj',
+        'nakazeni_orp',
+        'ockovani_orp',
+        'obyvatele_orp',
+        'umrti_cr',
+        'umrti_vek_okres_kraj',
+        'covid_po_obdobich_cr',
+        'nakazeni_po_obdobich_orp',
+        'ockovani_po_obdobich_orp',
+        'nakazeni_vek_okres_kraj_pocty',
+        'umrti_vek_okres_kraj_pocty',
+        'nakazeni_orp_mesice',
+        'ockovani_orp_mesice'
+    ]
+
     def __init__(self, compatibility: bool = False, log: bool = True, dbc: Union[DBC, None] = None) -> None:
         if dbc is None:
             self.dbc = DBC()
@@ -57,49 +78,33 @@ class CSVCreator():
         csv_name = 'A1-covid_po_mesicich'
         self.log_csv(csv_name)
 
-        coll_name = 'covid_po_dnech_cr'
-        coll = self.dbc.get_collection(coll_name)
-
         header = ['zacatek', 'konec', 'nakazeni', 'vyleceni', 'hospitalizovani', 'testy']
         month = relativedelta(months=1)
         day = relativedelta(days=1)
         dt = DateParser.parse('2020-04-01')
         dt_end = DateParser.parse('2021-12-01')
+
+        months = []
+        while dt < dt_end:
+            months.append(dt)
+            dt += month
+
+        sums = self.get_period_sums('mesic', 'covid_po_obdobich_cr', 'covid_po_dnech_cr', months, {
+            'nakazeni': 'prirustkovy_pocet_nakazenych',
+            'vyleceni': 'prirustkovy_pocet_vylecenych',
+            'hospitalizovani': 'pacient_prvni_zaznam',
+            'testy': 'prirustkovy_pocet_provedenych_testu'
+        })
+
         with self.csv_open(csv_name) as file:
             writer = self.get_csv_writer(file, header)
 
-            while dt < dt_end:
-                next_dt = dt + month
-                month_end = next_dt - day
-
-                pipeline = [
-                    {
-                        '$match': {
-                            '$and': [
-                                {'datum': {'$gte': dt}},
-                                {'datum': {'$lte': month_end}}
-                            ]
-                        }
-                    },
-                    {
-                        '$sort': {'datum': 1}
-                    },
-                    {
-                        '$group': {
-                            '_id': None,
-                            'nakazeni': {'$sum': '$prirustkovy_pocet_nakazenych'},
-                            'vyleceni': {'$sum': '$prirustkovy_pocet_vylecenych'},
-                            'hospitalizovani': {'$sum': '$pacient_prvni_zaznam'},
-                            'testy': {'$sum': '$prirustkovy_pocet_provedenych_testu'},
-                        }
-                    }
-                ]
-                cursor = coll.aggregate(pipeline)
-                doc = cursor.next()
+            for dt in months:
+                doc = sums.get((dt,), None)
                 if doc:
                     writer.writerow([
                         dt,
-                        month_end,
+                        dt + month - day,
                         doc['nakazeni'],
                         doc['vyleceni'],
                         doc['hospitalizovani'],
@@ -107,26 +112,53 @@ class CSVCreator():
                     ])
                 else:
                     raise CSVCreatorException(
-                        'Failed to retrieve data from collection "%s" for month beginning with %s' % (coll_name, dt)
+                        'Failed to retrieve data from collection "%s" for month beginning with %s' % ('covid_po_dnech_cr', dt)
                     )
 
-                dt = next_dt
-
     def query_A2(self) -> None:
         csv_name = 'A2-osoby_nakazeni_kraj'
         self.log_csv(csv_name)
 
-        coll = self.dbc.get_collection('nakazeni_vek_okres_kraj')
-
-        pipeline = [
-            {
-                '$project': {
-                    'kraj_nuts_kod': True,
-                    'vek': True,
-                    'nakaza_v_zahranici': True
+        if self.dbc.has_collection('nakazeni_vek_okres_kraj_pocty'):
+            # histogram of persons, rows are repeated pocet times, the rows are the same as from the raw collection
+            # but not in the order of the dataset
+            coll = self.dbc.get_collection('nakazeni_vek_okres_kraj_pocty')
+            pipeline = [
+                {
+                    '$group': {
+                        '_id': {
+                            'kraj_nuts_kod': '$kraj_nuts_kod',
+                            'vek': '$vek',
+                            'nakaza_v_zahranici': '$nakaza_v_zahranici'
+                        },
+                        'pocet': {'$sum': '$pocet'}
+                    }
+                },
+                {
+                    '$project': {
+                        '_id': False,
+                        'kraj_nuts_kod': '$_id.kraj_nuts_kod',
+                        'vek': '$_id.vek',
+                        'nakaza_v_zahranici': '$_id.nakaza_v_zahranici',
+                        'pocet': True
+                    }
+                },
+                # order of the groups is not defined, rows are sorted (the order of persons is not kept in the histogram)
+                {
+                    '$sort': {'kraj_nuts_kod': 1, 'vek': 1, 'nakaza_v_zahranici': 1}
                 }
-            }
-        ]
+            ]
+        else:
+            coll = self.dbc.get_collection('nakazeni_vek_okres_kraj')
+            pipeline = [
+                {
+                    '$project': {
+                        'kraj_nuts_kod': True,
+                        'vek': True,
+                        'nakaza_v_zahranici': True
+                    }
+                }
+            ]
         cursor = coll.aggregate(pipeline)
         header = ['kraj_nuts_kod', 'kraj_nazev', 'vek']
         with self.csv_open(csv_name) as file:
@@ -148,12 +180,14 @@ class CSVCreator():
             else:
                 kraj_nazev = self.kraje.get_nazev(doc['kraj_nuts_kod'])
             
-            writer.writerow([
-                kraj_nuts_kod,
-                kraj_nazev,
-                doc['vek']
-            ])
-            count += 1
+            pocet = doc.get('pocet', 1)
+            for _ in range(pocet):
+                writer.writerow([
+                    kraj_nuts_kod,
+                    kraj_nazev,
+                    doc['vek']
+                ])
+            count += pocet
 
         return count
 
@@ -198,6 +232,59 @@ class CSVCreator():
                     doc['kumulativni_pocet_nakazenych']
                 ])
 
+    def get_daily_collection_name(self, name: str, buckets_name: str) -> str:
+        """Monthly buckets of the ORP daily collection when they were created (see DBC.create_buckets)
+            Buckets have the same calendar fields and monthly sums of the daily values, so they can be grouped by month or quarter"""
+        return buckets_name if self.dbc.has_collection(buckets_name) else name
+
+    def get_period_sums(
+        self,
+        perioda: str,
+        rollup_name: str,
+        daily_name: str,
+        starts: List[datetime],
+        sums: Dict[str, str],
+        key: Tuple[str, ...] = (),
+        match: Union[dict, None] = None
+    ) -> Dict[tuple, dict]:
+        """Sums of fields (output name: field) over whole periods (see DBC.create_rollup) beginning with starts,
+            keyed by the values of key fields and the first day of the period
+            Periods are read from the rollup collection in one query, periods missing there
+            are grouped by the calendar fields of the daily records in one more query"""
+        for start in starts:
+            if get_period(start, perioda)[0] != start:
+                raise CSVCreatorException('%s is not the first day of period %s' % (start, perioda))
+
+        match = match if match is not None else {}
+        result = {}
+        coll = self.dbc.get_collection(rollup_name)
+        for doc in coll.find({'perioda': perioda, **match, 'datum_od': {'$in': starts}}):
+            result[tuple([doc[field] for field in key]) + (doc['datum_od'],)] = {name: doc[field] for name, field in sums.items()}
+
+        found = set(k[-1] for k in result)
+        fields = PERIOD_FIELDS[perioda]
+        periods = {tuple([get_calendar_fields(start)[field] for field in fields]): start for start in starts if start not in found}
+        if not periods:
+            return result
+
+        pipeline = [
+            {
+                '$match': {**match, '$or': [dict(zip(fields, period)) for period in periods]}
+            },
+            {
+                '$group': {
+                    '_id': {field: '$' + field for field in (*key, *fields)},
+                    **{name: {'$sum': '$' + field} for name, field in sums.items()}
+                }
+            }
+        ]
+        coll = self.dbc.get_collection(daily_name)
+        for doc in coll.aggregate(pipeline):
+            start = periods[tuple([doc['_id'][field] for field in fields])]
+            result[tuple([doc['_id'][field] for field in key]) + (start,)] = {name: doc[name] for name in sums}
+
+        return result
+
     def get_population_collection_max_date(self) -> int:
         coll_name = 'obyvatelstvo_kraj'
         coll = self.dbc.get_collection(coll_name)
@@ -258,24 +345,36 @@ class CSVCreator():
         total_quarters = 4
         dates = self.get_quarters_dates(self.FIRST_QUARTER_DATE, total_quarters)
 
+        infected, vaccinations = self.get_ORP_infected_and_vaccinations([orp['orp_kod'] for orp in orps], dates[0::2])
+
         count = 0
         header = ['datum_zacatek', 'datum_konec', 'orp_kod', 'orp_nazev', '0-14', '15-59', '60+', 'nakazeni', 'pocet_davek']
         with self.csv_open(csv_name) as file:
             writer = self.get_csv_writer(file, header)
             for orp in orps:
+                orp_code = orp['orp_kod']
                 for i in range(total_quarters):
                     pos = i * 2
-                    infected, vaccinations = self.get_ORP_infected_and_vaccinations(orp['orp_kod'], dates[pos], dates[pos + 1])
+                    start, end = dates[pos], dates[pos + 1]
+                    if (orp_code, start) not in infected:
+                        raise CSVCreatorException(
+                            'Failed to retrieve infection data for ORP (%s) %s %s-%s' % (self.orp.get_orp_nazev(orp_code), orp_code, start, end)
+                        )
+                    if (orp_code, start) not in vaccinations:
+                        raise CSVCreatorException(
+                            'Failed to retrieve vaccination data for ORP (%s) %i %s-%s' % (self.orp.get_orp_kod(orp_code), orp_code, start, end)
+                        )
+
                     writer.writerow([
-                        dates[pos],
-                        dates[pos + 1],
+                        start,
+                        end,
                         self.orp.get_orp_kod(orp['orp_nazev']), # code according to the ČSÚ ORP codebook
                         orp['orp_nazev'],
                         orp['0-14'],
                         orp['15-59'],
                         orp['60+'],
-                        infected,
-                        vaccinations
+                        infected[(orp_code, start)]['nakazeni'],
+                        vaccinations[(orp_code, start)]['pocet_davek']
                     ])
                     count += 1
 
@@ -285,60 +384,17 @@ class CSVCreator():
                 'Loaded invalid amount of rows for query C1 (actual: %i, expected: %i)' % (count, expected)
             )
 
-    def get_ORP_infected_and_vaccinations(self, orp_code: int, start: datetime, end: datetime) -> Tuple[int, int]:
-        coll = self.dbc.get_collection('nakazeni_orp')
-        pipeline = [
-            {
-                '$match': {
-                    '$and': [
-                        {'orp_kod': {'$eq': orp_code}},
-                        {'datum': {'$gte': start}},
-                        {'datum': {'$lte': end}}
-                    ]
-                }
-            },
-            {
-                '$group': {
-                    '_id': None,
-                    'nakazeni': {'$sum': '$nove_pripady'}
-                }
-            }
-        ]
-        cursor = coll.aggregate(pipeline)
-        try:
-            doc_infected = cursor.next()
-        except StopIteration:
-            raise CSVCreatorException(
-                'Failed to retrieve infection data for ORP (%s) %s %s-%s' % (self.orp.get_orp_nazev(orp_code), orp_code, start, end)
-            )
-
-        coll = self.dbc.get_collection('ockovani_orp')
-        pipeline = [
-            {
-                '$match': {
-                    '$and': [
-                        {'orp_kod': {'$eq': orp_code}},
-                        {'datum': {'$gte': start}},
-                        {'datum': {'$lte': end}}
-                    ]
-                }
-            },
-            {
-                '$group': {
-                    '_id': None,
-                    'pocet_davek': {'$sum': '$pocet_davek'}
-                }
-            }
-        ]
-        cursor = coll.aggregate(pipeline)
-        try:
-            doc_vaccinations = cursor.next()
-        except StopIteration:
-            raise CSVCreatorException(
-                'Failed to retrieve vaccination data for ORP (%s) %i %s-%s' % (self.orp.get_orp_kod(orp_code), orp_code, start, end)
-            )
+    def get_ORP_infected_and_vaccinations(self, orp_codes: List[int], starts: List[datetime]) -> Tuple[Dict[tuple, dict], Dict[tuple, dict]]:
+        """Infections and vaccination doses of the ORPs in quarters, keyed by (orp_kod, first day of the quarter)"""
+        match = {'orp_kod': {'$in': orp_codes}}
+        # the quarterly rollups have one document per ORP and quarter (fewer than 3 monthly buckets), buckets or daily
+        # documents are read only for quarters missing in the rollups
+        infected_daily = self.get_daily_collection_name('nakazeni_orp', 'nakazeni_orp_mesice')
+        infected = self.get_period_sums('ctvrtleti', 'nakazeni_po_obdobich_orp', infected_daily, starts, {'nakazeni': 'nove_pripady'}, ('orp_kod',), match)
+        vaccinations_daily = self.get_daily_collection_name('ockovani_orp', 'ockovani_orp_mesice')
+        vaccinations = self.get_period_sums('ctvrtleti', 'ockovani_po_obdobich_orp', vaccinations_daily, starts, {'pocet_davek': 'pocet_davek'}, ('orp_kod',), match)
 
-        return (doc_infected['nakazeni'], doc_vaccinations['pocet_davek'])
+        return (infected, vaccinations)
 
     def get_most_populous_ORPs(self, limit: int = 50) -> List[dict]:
         coll = self.dbc.get_collection('obyvatele_orp')
@@ -420,7 +476,7 @@ class CSVCreator():
                 },
                 {
                     '$lookup': {
-                        'from': 'covid_po_dnech_cr',
+                        'from': 'covid_po_obdobich_cr',
                         'let': {
                             'datum_od': '$casref_od',
                             'datum_do': '$casref_do'
@@ -428,18 +484,18 @@ class CSVCreator():
                         'pipeline': [
                             {
                                 '$match': {
+                                    'perioda': 'tyden',
                                     '$expr': {
                                         '$and': [
-                                            {'$gte': ['$datum', '$$datum_od']},
-                                            {'$lte': ['$datum', '$$datum_do']}
+                                            {'$eq': ['$datum_od', '$$datum_od']},
+                                            {'$eq': ['$datum_do', '$$datum_do']}
                                         ]
                                     }
                                 }
                             },
                             {
-                                '$group': {
-                                    '_id': None,
-                                    'umrti_covid': {'$sum': '$prirustkovy_pocet_umrti'}
+                                '$project': {
+                                    'umrti_covid': '$prirustkovy_pocet_umrti'
                                 }
                             },
                             {
@@ -487,47 +543,57 @@ class CSVCreator():
                     }
                 }
             ]
-            cursor = coll.aggregate(pipeline)
+            docs = list(coll.aggregate(pipeline))
 
-            coll_covid = self.dbc.get_collection('covid_po_dnech_cr')
+            # ISO weeks are summed in one query, other ranges are aggregated when writing the row
+            weeks = set(doc['datum_od'] for doc in docs if get_period(doc['datum_od'], 'tyden') == (doc['datum_od'], doc['datum_do']))
+            umrti_covid = self.get_period_sums('tyden', 'covid_po_obdobich_cr', 'covid_po_dnech_cr', sorted(weeks), {'umrti_covid': 'prirustkovy_pocet_umrti'})
 
             with self.csv_open(csv_name) as file:
                 writer = self.get_csv_writer(file, header)
-                for doc in cursor:
-                    pipeline_covid = [
-                        {
-                            '$match': {
-                                '$and': [
-                                    {'datum': {'$gte': doc['datum_od']}},
-                                    {'datum': {'$lte': doc['datum_do']}}
-                                ]
-                            }
-                        },
-                        {
-                            '$group': {
-                                '_id': None,
-                                'umrti_covid': {'$sum': '$prirustkovy_pocet_umrti'}
-                            }
-                        },
-                        {
-                            '$limit': 1
-                        }
-                    ]
-                    cursor_covid = coll_covid.aggregate(pipeline_covid)
-                    try:
-                        doc_umrti_covid = cursor_covid.next()
-                        doc['umrti_covid'] = doc_umrti_covid['umrti_covid']
-                    except StopIteration:
-                        doc['umrti_covid'] = None
-                        
+                for doc in docs:
+                    if doc['datum_od'] in weeks:
+                        doc['umrti_covid'] = umrti_covid.get((doc['datum_od'],), {}).get('umrti_covid', None)
+
                     self.write_query_D1_row(doc, writer)
 
+    def get_covid_deaths(self, start: datetime, end: datetime) -> Union[int, None]:
+        coll_covid = self.dbc.get_collection('covid_po_dnech_cr')
+        pipeline_covid = [
+            {
+                '$match': {
+                    '$and': [
+                        {'datum': {'$gte': start}},
+                        {'datum': {'$lte': end}}
+                    ]
+                }
+            },
+            {
+                '$group': {
+                    '_id': None,
+                    'umrti_covid': {'$sum': '$prirustkovy_pocet_umrti'}
+                }
+            },
+            {
+                '$limit': 1
+            }
+        ]
+        cursor_covid = coll_covid.aggregate(pipeline_covid)
+        try:
+            return cursor_covid.next()['umrti_covid']
+        except StopIteration:
+            return None
+
     def write_query_D1_row(self, doc: dict, writer) -> None:
+        # weeks that are not in the rollup collection are aggregated from the daily records
+        if 'umrti_covid' not in doc:
+            doc['umrti_covid'] = self.get_covid_deaths(doc['datum_od'], doc['datum_do'])
+
         writer.writerow([
             doc['datum_od'],
             doc['datum_do'],
             doc['umrti'],
-            doc.get('umrti_covid', None)
+            doc['umrti_covid']
         ])
 
     def write_query_D1_data(self, cursor: CommandCursor, writer) -> int:
@@ -541,7 +607,12 @@ class CSVCreator():
         csv_name = 'D2-zemreli_vekove_kategorie'
         self.log_csv(csv_name)
 
-        coll = self.dbc.get_collection('umrti_vek_okres_kraj')
+        if self.dbc.has_collection('umrti_vek_okres_kraj_pocty'):
+            coll = self.dbc.get_collection('umrti_vek_okres_kraj_pocty')
+            count_stage = {'$group': {'_id': None, 'umrti': {'$sum': '$pocet'}}}
+        else:
+            coll = self.dbc.get_collection('umrti_vek_okres_kraj')
+            count_stage = {'$count': 'umrti'}
 
         population_groups = self.get_cze_population_groups()
 
@@ -566,9 +637,7 @@ class CSVCreator():
                             '$and': and_cond
                         }
                     },
-                    {
-                        '$count': 'umrti'
-                    }
+                    count_stage
                 ]
                 cursor = coll.aggregate(pipeline)
                 try:
@@ -679,6 +748,44 @@ class CSVCreator():
         self.query_D1()
         self.query_D2()
 
+    def get_index_usage(self) -> Dict[str, dict]:
+        """Operations of each index (indexes) and collection scans (scans, None when not reported) of the queried
+            collections, collections that were not created (e.g. histograms, buckets) are left out"""
+        usage = {}
+        for coll_name in self.QUERY_COLLECTIONS:
+            if not self.dbc.has_collection(coll_name):
+                continue
+
+            usage[coll_name] = {
+                'indexes': {doc['name']: doc['accesses']['ops'] for doc in self.dbc.get_index_stats(coll_name)},
+                'scans': self.dbc.get_collection_scans(coll_name)
+            }
+
+        return usage
+
+    def report_index_usage(self, before: Dict[str, dict], after: Dict[str, dict]) -> None:
+        """Print how many times each index was used and how many collection scans were done between the two snapshots
+            of get_index_usage, collections the queries did not read are reported separately"""
+        print('\nIndex usage of the queries:')
+        for coll_name, stats in after.items():
+            previous = before.get(coll_name, {'indexes': {}, 'scans': 0})
+            used = {name: ops - previous['indexes'].get(name, 0) for name, ops in stats['indexes'].items()}
+            scans = stats['scans'] - (previous['scans'] or 0) if stats['scans'] is not None else None
+
+            if not any(used.values()):
+                if scans is None:
+                    print('%s:\tno index used (collection scan or not queried)' % coll_name)
+                elif scans:
+                    print('%s:\tno index used (%i collection scans)' % (coll_name, scans))
+                else:
+                    print('%s:\tnot queried' % coll_name)
+                continue
+
+            for name, ops in used.items():
+                print('%s:\t%s\t%i' % (coll_name, name, ops))
+            if scans:
+                print('%s:\t%i collection scans' % (coll_name, scans))
+
     def log_csv(self, csv_name: str) -> None:
         if self.log:
             print('Creating %s' % csv_name + '.csv', flush=True)
@@ -699,17 +806,24 @@ def main() -> None:
     argparser.add_argument('-H', '--host', dest='host', help='DB server host', default=DBC.DEFAULT_HOST, type=str, required=False)
     argparser.add_argument('-p', '--port', dest='port', help='DB server port number', default=DBC.DEFAULT_PORT, type=int, required=False)
     argparser.add_argument('-t', '--timeout', dest='timeout', help='timeout for server connection', default=None, type=int, required=False)
+    argparser.add_argument('--index-stats', dest='index_stats', help='report index usage of the queries', action='store_true', required=False)
 
     args, _ = argparser.parse_known_args(sys.argv)
 
     dbc = DBC(args.host, args.port, args.timeout)
     csv_creator = CSVCreator(compatibility=True, log=True, dbc=dbc)
 
+    if args.index_stats:
+        index_usage = csv_creator.get_index_usage()
+
     try:
         csv_creator.create_all_csv_files()
     except CSVCreatorException as exc:
         print(exc)
         sys.exit(2)
 
+    if args.index_stats:
+        csv_creator.report_index_usage(index_usage, csv_creator.get_index_usage())
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,145 @@
+##
+# @file aggregate.py
+# Subject: UPA - Data Storage and Preparation
+# @date: 10/2026
+# Single pass hash aggregation of records
+
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+from .extsort import SizeEstimator, SortedRuns
+
+class Reducer:
+    def __init__(self, field: str) -> None:
+        self.field = field
+
+class Sum(Reducer):
+    """Sum of the field over the group"""
+
+class First(Reducer):
+    """Value of the field in the first record of the group, None if missing"""
+
+class Last(Reducer):
+    """Value of the field in the last record of the group, None if missing"""
+
+class Count(Reducer):
+    """Number of records in the group"""
+
+    def __init__(self) -> None:
+        super().__init__(None)
+
+class Push(Reducer):
+    """List of the values of the field in all records of the group, in the order of the input"""
+
+def sort_key(key: tuple) -> tuple:
+    """Order of group keys, None values are placed after the other values of the field"""
+    return tuple([(value is None, value) for value in key])
+
+class GroupBy:
+    """Groups records by a tuple of key fields in a single pass and reduces the other fields
+        With memory_budget (bytes) partial groups are spilled to temporary files sorted by key when the budget is exceeded
+        and combined when reading the results
+        Usage:
+            group = GroupBy({'datum': 'datum', 'orp_kod': 'orp_bydliste_kod'}, {'pocet_davek': Sum('pocet_davek')})
+            group.update(records)
+            documents = group.results()"""
+
+    def __init__(self, key: Union[Dict[str, str], Tuple[str, ...]], reducers: Dict[str, Reducer], memory_budget: Union[int, None] = None) -> None:
+        # key maps output fields to source fields, a tuple keeps the names
+        if not isinstance(key, dict):
+            key = {field: field for field in key}
+
+        self.key_names = list(key.keys())
+        self.key_fields = list(key.values())
+        self.names = list(reducers.keys())
+        self.fields = [reducer.field for reducer in reducers.values()]
+        self.sums = [i for i, reducer in enumerate(reducers.values()) if isinstance(reducer, Sum)]
+        self.lasts = [i for i, reducer in enumerate(reducers.values()) if isinstance(reducer, Last)]
+        self.counts = [i for i, reducer in enumerate(reducers.values()) if isinstance(reducer, Count)]
+        self.pushes = [i for i, reducer in enumerate(reducers.values()) if isinstance(reducer, Push)]
+
+        self.groups: Dict[tuple, List] = {}
+
+        self.memory_budget = memory_budget
+        self.estimator = SizeEstimator()
+        self.runs = SortedRuns()
+
+    def add(self, record: dict) -> None:
+        key = tuple([record[field] for field in self.key_fields])
+        acc = self.groups.get(key)
+        if acc is None:
+            acc = self.groups[key] = [record.get(field, None) for field in self.fields]
+            for i in self.counts:
+                acc[i] = 1
+            for i in self.pushes:
+                acc[i] = [acc[i]]
+            if self.memory_budget is not None:
+                self.estimator.add((key, acc))
+                if self.estimator.get_bytes(len(self.groups)) > self.memory_budget:
+                    self.spill()
+            return
+
+        for i in self.sums:
+            acc[i] += record[self.fields[i]]
+        for i in self.lasts:
+            acc[i] = record.get(self.fields[i], None)
+        for i in self.counts:
+            acc[i] += 1
+        for i in self.pushes:
+            acc[i].append(record.get(self.fields[i], None))
+
+    def combine(self, acc: List, other: List) -> None:
+        for i in self.sums:
+            acc[i] += other[i]
+        for i in self.lasts:
+            acc[i] = other[i]
+        for i in self.counts:
+            acc[i] += other[i]
+        for i in self.pushes:
+            acc[i].extend(other[i])
+
+    def spill(self) -> None:
+        self.runs.spill(sorted(self.groups.items(), key=lambda x: sort_key(x[0])))
+        self.groups = {}
+
+    def merge_runs(self) -> Iterator[Tuple[tuple, List]]:
+        # runs are in the order of the input, first values come from the earliest run
+        current = None
+        groups = sorted(self.groups.items(), key=lambda x: sort_key(x[0]))
+        for key, acc in self.runs.merge(lambda x: sort_key(x[0]), (groups,)):
+            if current is not None and current[0] == key:
+                self.combine(current[1], acc)
+                continue
+            if current is not None:
+                yield current
+            current = (key, acc)
+
+        if current is not None:
+            yield current
+
+        self.groups = {}
+
+    def update(self, records: Iterable[dict]) -> 'GroupBy':
+        for record in records:
+            self.add(record)
+
+        return self
+
+    def results(self, sort: bool = True) -> Iterator[dict]:
+        """Aggregated records, ordered by the key when sort is set or when groups were spilled"""
+        if self.runs:
+            groups = self.merge_runs()
+        elif sort:
+            groups = ((key, self.groups[key]) for key in sorted(self.groups, key=sort_key))
+        else:
+            groups = self.groups.items()
+
+        for key, acc in groups:
+            doc = dict(zip(self.key_names, key))
+            doc.update(zip(self.names, acc))
+            yield doc
+
+    def __len__(self) -> int:
+        return len(self.groups)
+
+def group_by(records: Iterable[dict], key: Union[Dict[str, str], Tuple[str, ...]], reducers: Dict[str, Reducer], sort: bool = True, memory_budget: Union[int, None] = None) -> Iterator[dict]:
+    return GroupBy(key, reducers, memory_budget).update(records).results(sort)
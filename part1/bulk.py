@@ -0,0 +1,134 @@
+##
+# @file bulk.py
+# Subject: UPA - Data Storage and Preparation
+# @date: 10/2026
+# Chunked unordered bulk inserts with adaptive batch size
+
+import bson
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Union
+from pymongo.collection import Collection
+from bson.raw_bson import RawBSONDocument
+
+class BulkWriter:
+    """Inserts documents in unordered insert_many chunks
+        Without a fixed batch_size the chunk size follows the average BSON size of sampled documents,
+        so that one chunk stays around max_batch_bytes
+        With background chunks are inserted by threads while the next one is collected, at most BACKGROUND_CHUNKS chunks
+        are in flight (each on its own connection of the pool, so one is encoded while the server inserts the other)"""
+
+    MAX_BATCH_COUNT = 100000 # maxWriteBatchSize of mongod
+    MAX_BATCH_BYTES = 8 * 1024 * 1024
+    SAMPLE_INTERVAL = 1000
+    LOG_INTERVAL = 10.0
+    BACKGROUND_CHUNKS = 2
+
+    def __init__(
+        self,
+        coll: Collection,
+        batch_size: Union[int, None] = None,
+        max_batch_bytes: int = MAX_BATCH_BYTES,
+        bypass_validation: bool = False,
+        log: bool = False,
+        background: bool = False
+    ) -> None:
+        self.coll = coll
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.bypass_validation = bypass_validation
+        self.log = log
+        self.background = background
+        self.pending: deque = deque()
+        self.lock = threading.Lock()
+
+        self.inserted = 0
+        self.start = None
+        self.sampled = 0
+        self.sampled_bytes = 0
+        self.last_log = 0.0
+
+    def get_batch_size(self) -> int:
+        if self.batch_size is not None:
+            return self.batch_size
+        if not self.sampled:
+            return 1
+
+        avg_size = self.sampled_bytes / self.sampled
+        return int(max(1, min(self.MAX_BATCH_COUNT, self.max_batch_bytes // avg_size)))
+
+    def sample(self, doc: dict) -> None:
+        self.sampled += 1
+        self.sampled_bytes += len(doc.raw) if isinstance(doc, RawBSONDocument) else len(bson.encode(doc))
+
+    def get_elapsed(self) -> float:
+        return time.perf_counter() - self.start if self.start is not None else 0.0
+
+    def get_rate(self) -> float:
+        # rows per second including reading and transforming the documents
+        elapsed = self.get_elapsed()
+        return self.inserted / elapsed if elapsed else 0.0
+
+    def flush(self, batch: List[dict]) -> None:
+        if not batch:
+            return
+
+        self.coll.insert_many(batch, ordered=False, bypass_document_validation=self.bypass_validation)
+
+        # background chunks are flushed by several threads
+        with self.lock:
+            self.inserted += len(batch)
+
+            elapsed = self.get_elapsed()
+            if self.log and elapsed - self.last_log >= self.LOG_INTERVAL:
+                self.last_log = elapsed
+                print('%s:\t%i documents (%.0f docs/s)' % (self.coll.name, self.inserted, self.get_rate()), flush=True)
+
+    def submit(self, executor: Union[ThreadPoolExecutor, None], batch: List[dict]) -> None:
+        if executor is None:
+            self.flush(batch)
+            return
+
+        # insert_many releases the GIL while it waits on the socket, so the previous chunks are inserted while this one
+        # is collected and encoded
+        self.wait(self.BACKGROUND_CHUNKS - 1)
+        self.pending.append(executor.submit(self.flush, batch))
+
+    def wait(self, limit: int = 0) -> None:
+        """Wait until at most limit chunks are in flight"""
+        while len(self.pending) > limit:
+            self.pending.popleft().result()
+
+    def write(self, documents: Iterable[dict]) -> int:
+        if self.start is None:
+            self.start = time.perf_counter()
+
+        executor = ThreadPoolExecutor(max_workers=self.BACKGROUND_CHUNKS, thread_name_prefix='bulk') if self.background else None
+        batch = []
+        count = 0
+        try:
+            for doc in documents:
+                if self.batch_size is None and count % self.SAMPLE_INTERVAL == 0:
+                    self.sample(doc)
+                count += 1
+
+                batch.append(doc)
+                if len(batch) >= self.get_batch_size():
+                    self.submit(executor, batch)
+                    batch = []
+
+            self.submit(executor, batch)
+            self.wait()
+        finally:
+            # after a failure the chunks in flight are finished, their errors are not raised over the original one
+            if executor is not None:
+                executor.shutdown(wait=True)
+            self.pending.clear()
+
+        if self.log:
+            print('%s:\t%i documents inserted (%.0f docs/s)' % (self.coll.name, self.inserted, self.get_rate()), flush=True)
+
+        return count
@@ -9,7 +9,7 @@ import csv
 
 from typing import Tuple, Union
 
-from .download import DATA_PATH
+from .dataset import open_dataset
 
 UZEMI_OKRES = 101
 UZEMI_KRAJ = 100
@@ -44,7 +44,7 @@ class ORP:
 
     @staticmethod
     def load_orp_zkracene() -> dict:
-        with open('%s/%s' % (DATA_PATH, 'orp-ciselnik.csv'), 'r', encoding='windows-1250') as file:
+        with open_dataset('orp-ciselnik.csv', encoding='windows-1250') as file:
             header = [
                 'KODJAZ',
                 'AKRCIS',
@@ -68,7 +68,7 @@ class ORP:
     @staticmethod
     def create_orp_kraje_vazba_json() -> dict:
         orp_zkracene = ORP.load_orp_zkracene()
-        with open('%s/%s' % (DATA_PATH, 'vazba-orp-kraj.csv'), 'r', encoding='windows-1250') as file:
+        with open_dataset('vazba-orp-kraj.csv', encoding='windows-1250') as file:
             header = [
                 'KODJAZ',
                 'TYPVAZ',
@@ -152,7 +152,7 @@ class Kraje:
 
     @staticmethod
     def load_kraje_ciselnik() -> dict:
-        with open('%s/%s' % (DATA_PATH, 'kraj-ciselnik.csv'), 'r', encoding='windows-1250') as file:
+        with open_dataset('kraj-ciselnik.csv', encoding='windows-1250') as file:
             header = [
                 'KODJAZ',
                 'AKRCIS',
@@ -190,7 +190,7 @@ class Kraje:
         return Kraje.NUTS3.get(nuts, None)
 
 def get_csu7700_ciselnik() -> dict:
-    with open('%s/%s' % (DATA_PATH, 'csu7700.csv'), 'r', encoding='windows-1250') as file:
+    with open_dataset('csu7700.csv', encoding='windows-1250') as file:
         reader = csv.DictReader(file)
         vek_kody = {}
         for line in reader:
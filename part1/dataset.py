@@ -0,0 +1,135 @@
+##
+# @file dataset.py
+# Subject: UPA - Data Storage and Preparation
+# @date: 10/2026
+# Access to downloaded datasets stored plain or compressed
+
+import csv
+import gzip
+import hashlib
+import io
+import os
+import shutil
+
+from typing import IO, Iterable, Iterator, List, Union
+
+from .jsonstream import iter_json_data
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+
+SUFFIXES = {
+    COMPRESSION_GZIP: '.gz',
+    COMPRESSION_ZSTD: '.zst'
+}
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+def data_path() -> str:
+    # imported here, download.py uses this module
+    from .download import DATA_PATH
+    return DATA_PATH
+
+def check_compression(compression: Union[str, None]) -> None:
+    if compression is not None and compression not in SUFFIXES:
+        raise ValueError('Unknown compression %s (expected one of: %s)' % (compression, ', '.join(SUFFIXES)))
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        raise ValueError('Compression %s requires the zstandard module' % compression)
+
+def stored_name(name: str, compression: Union[str, None] = None) -> str:
+    return name + SUFFIXES[compression] if compression is not None else name
+
+def stored_variants(name: str) -> List[str]:
+    return [name] + [name + suffix for suffix in SUFFIXES.values()]
+
+def find_dataset(name: str, path: Union[str, None] = None) -> Union[str, None]:
+    """Path of the stored dataset, plain file is preferred over the compressed ones"""
+    path = path if path is not None else data_path()
+    for variant in stored_variants(name):
+        fpath = os.path.join(path, variant)
+        if os.path.isfile(fpath):
+            return fpath
+
+    return None
+
+def open_binary(fpath: str) -> IO[bytes]:
+    if fpath.endswith(SUFFIXES[COMPRESSION_GZIP]):
+        return gzip.open(fpath, 'rb')
+    if fpath.endswith(SUFFIXES[COMPRESSION_ZSTD]):
+        if zstandard is None:
+            raise OSError('Reading %s requires the zstandard module' % fpath)
+        return zstandard.ZstdDecompressor().stream_reader(open(fpath, 'rb'), closefd=True)
+
+    return open(fpath, 'rb')
+
+def open_dataset(name: str, encoding: Union[str, None] = 'utf-8', newline: Union[str, None] = None, path: Union[str, None] = None) -> IO:
+    """Open downloaded dataset by its name from DATA, decompresses transparently
+        Returns a text file, or a binary one when encoding is None"""
+    fpath = find_dataset(name, path)
+    if fpath is None:
+        raise FileNotFoundError('Dataset %s not found in %s' % (name, path if path is not None else data_path()))
+
+    file = open_binary(fpath)
+    if encoding is None:
+        return file
+
+    return io.TextIOWrapper(file, encoding=encoding, newline=newline)
+
+def hash_dataset(name: str, path: Union[str, None] = None) -> str:
+    """SHA-256 of the decompressed content of the dataset, same as the hash in the download manifest"""
+    sha256 = hashlib.sha256()
+    with open_dataset(name, encoding=None, path=path) as file:
+        for chunk in iter(lambda: file.read(COPY_BUFFER_SIZE), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+def compress_file(src: str, dst: str, compression: str) -> None:
+    """Compress src into dst, dst is written atomically and src is kept"""
+    check_compression(compression)
+
+    tmp_path = dst + '.part'
+    with open(src, 'rb') as file_in:
+        if compression == COMPRESSION_GZIP:
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as file_out:
+                shutil.copyfileobj(file_in, file_out, COPY_BUFFER_SIZE)
+        else:
+            with open(tmp_path, 'wb') as file_out:
+                zstandard.ZstdCompressor(level=9, threads=-1).copy_stream(file_in, file_out)
+
+    os.replace(tmp_path, dst)
+
+def read_json_data(name: str, key: str = 'data') -> Iterator[dict]:
+    """Records of a downloaded JSON dataset, parsed incrementally"""
+    with open_dataset(name) as file:
+        yield from iter_json_data(file, key)
+
+def read_csv_data(name: str, fields: Union[Iterable[str], None] = None, encoding: str = 'utf-8') -> Iterator[dict]:
+    """Rows of a downloaded CSV dataset as dicts of the given columns (all for None)
+        Fields that are not columns of the dataset are ignored, they are computed by the caller"""
+    with open_dataset(name, encoding=encoding, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:
+            return
+
+        if fields is None:
+            columns = list(enumerate(header))
+        else:
+            fields = set(fields)
+            columns = [(i, column) for i, column in enumerate(header) if column in fields]
+
+        width = len(header)
+        for row in reader:
+            # like csv.DictReader, empty rows are skipped and missing values of short rows are None
+            if not row:
+                continue
+            if len(row) < width:
+                row += [None] * (width - len(row))
+
+            yield {column: row[i] for i, column in columns}
@@ -0,0 +1,93 @@
+##
+# @file dates.py
+# Subject: UPA - Data Storage and Preparation
+# @date: 10/2026
+# Fast parsing of dates in the datasets
+
+import timeit
+
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Tuple
+from dateutil import parser as DateParser
+from dateutil.relativedelta import relativedelta
+
+CACHE_SIZE = 8192
+
+# ISO week (Monday - Sunday), calendar month and quarter
+PERIODS = ('tyden', 'mesic', 'ctvrtleti')
+
+# calendar fields identifying the period
+PERIOD_FIELDS = {
+    'tyden': ('iso_rok', 'iso_tyden'),
+    'mesic': ('rok', 'mesic'),
+    'ctvrtleti': ('rok', 'ctvrtleti')
+}
+
+EPOCH = datetime(1970, 1, 1)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_date(value: str) -> datetime:
+    """Parse date from the datasets, same result as DateParser.parse
+        YYYY-MM-DD is parsed directly, other formats fall back to dateutil; results are cached"""
+    if len(value) == 10 and value[4] == '-' and value[7] == '-':
+        try:
+            return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+        except ValueError:
+            pass
+
+    return DateParser.parse(value)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def get_period(value: datetime, period: str) -> Tuple[datetime, datetime]:
+    """First and last day of the period (one of PERIODS) containing the date"""
+    day = datetime(value.year, value.month, value.day)
+    if period == 'tyden':
+        start = day - timedelta(days=day.weekday())
+        return (start, start + timedelta(days=6))
+    if period == 'mesic':
+        start = day.replace(day=1)
+        return (start, start + relativedelta(months=1, days=-1))
+    if period == 'ctvrtleti':
+        start = day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+        return (start, start + relativedelta(months=3, days=-1))
+
+    raise ValueError('Unknown period %s' % period)
+
+@lru_cache(maxsize=CACHE_SIZE)
+def get_calendar_fields(value: datetime) -> Dict[str, int]:
+    """Integer calendar fields of the date, den_index is the number of days since 1970-01-01"""
+    iso_rok, iso_tyden, _ = value.isocalendar()
+    return {
+        'rok': value.year,
+        'mesic': value.month,
+        'ctvrtleti': (value.month - 1) // 3 + 1,
+        'iso_rok': iso_rok,
+        'iso_tyden': iso_tyden,
+        'den_index': (datetime(value.year, value.month, value.day) - EPOCH).days
+    }
+
+def benchmark(name: str = 'kraj-okres-nakazeni.json', repeat: int = 3) -> None:
+    """Compare parsing of dates of the nakazeni_vek_okres_kraj source with dateutil"""
+    from .dataset import read_json_data
+
+    values = [data['datum'] for data in read_json_data(name)]
+
+    def parse_dateutil():
+        for value in values:
+            DateParser.parse(value)
+
+    def parse_cached():
+        parse_date.cache_clear()
+        for value in values:
+            parse_date(value)
+
+    dateutil_time = min(timeit.repeat(parse_dateutil, number=1, repeat=repeat))
+    cached_time = min(timeit.repeat(parse_cached, number=1, repeat=repeat))
+
+    print('%s: %i dates, %i distinct' % (name, len(values), len(set(values))))
+    print('dateutil:\t%.3f s' % dateutil_time)
+    print('parse_date:\t%.3f s (%.1fx)' % (cached_time, dateutil_time / cached_time if cached_time else 0.0))
+
+if __name__ == '__main__':
+    benchmark()
@@ -6,28 +6,355 @@
 # @date: 11/2021
 # Parse downloaded data and import them to DB
 
+import bson
+import hashlib
+import inspect
 import pymongo
 import sys
-import json
-import csv
-
-from dateutil import parser as DateParser
-from typing import Union, Tuple
-from collections import OrderedDict
+import time
+
+from typing import Callable, Dict, Union, Tuple, Iterable, Iterator, List
+from collections import deque
+from itertools import islice
+from datetime import datetime, timedelta
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from pymongo.collection import Collection
+from bson.raw_bson import RawBSONDocument
 
-from .download import DATA_PATH
+from .dataset import read_csv_data, read_json_data, hash_dataset
+from .download import Manifest
+from .dates import parse_date, get_period, get_calendar_fields, PERIODS
+from .bulk import BulkWriter
 from .ciselniky import UZEMI_KRAJ, Kraje, ORP, get_csu7700_ciselnik
-from .merge import mergeListsByKey, mergeListsByTwoKeys
+from .merge import merge_join, hash_join
+from .aggregate import group_by, Sum, First, Count, Push
+from .extsort import DEFAULT_MEMORY_BUDGET
+from .jsonstream import JSONStreamError, batched
+from .pipeline import pipelined
+from .jsonchunks import map_json_data, check_backend
+from .schema import Schema, Field, nullable, optional, int_or_none, int_or_empty
+
+# builder - DBC method creating the collection
+# sources - datasets the collection is created from, including codebooks
+# depends - collections that have to be created first
+# indexes - secondary indexes (lists of (field, direction)) built after the documents are inserted
+# buckets - ORP daily collection stored in monthly buckets, created with --buckets
+# layout - per person collections are stored as raw records or as a histogram of distinct records with pocet, see DBC.HISTOGRAMS
+# delta - daily series keyed by datum that can be ingested incrementally, see DBC.append_collection
+# schema - name of the schema in SCHEMAS the documents are created with, when it is not the name of the collection
+# version - increased when the documents change for reasons the definition hash does not see (e.g. codebook data), default 0
+COLLECTIONS: List[dict] = [
+    {'name': 'obyvatelstvo_kraj', 'builder': 'create_collection_obyvatelstvo_kraj', 'sources': ['kraj-okres-obyvatelstvo.csv', 'kraj-ciselnik.csv'],
+        'indexes': [[('pohlavi_kod', pymongo.ASCENDING), ('vek_kod', pymongo.ASCENDING), ('casref_do', pymongo.ASCENDING)]]},
+    {'name': 'covid_po_dnech_cr', 'builder': 'create_collection_covid_po_dnech_cr', 'sources': ['cr-hospitalizace-umrti.json', 'cr-nakazeni-vyleceni-umrti-testy.json', 'cr-testy.json'], 'delta': True,
+        'indexes': [[('datum', pymongo.ASCENDING)], [('rok', pymongo.ASCENDING), ('mesic', pymongo.ASCENDING)], [('iso_rok', pymongo.ASCENDING), ('iso_tyden', pymongo.ASCENDING)]]},
+    {'name': 'nakazeni_vek_okres_kraj', 'builder': 'create_collection_nakazeni_vek_okres_kraj', 'sources': ['kraj-okres-nakazeni.json'], 'delta': True, 'layout': 'raw'},
+    {'name': 'nakazeni_vek_okres_kraj_pocty', 'builder': 'create_collection_nakazeni_vek_okres_kraj_pocty', 'sources': ['kraj-okres-nakazeni.json'], 'delta': True, 'layout': 'histogram',
+        'schema': 'nakazeni_vek_okres_kraj'},
+    {'name': 'nakazeni_vyleceni_umrti_testy_kraj', 'builder': 'create_collection_nakazeni_vyleceni_umrti_testy_kraj', 'sources': ['kraj-okres-testy.json', 'kraj-okres-nakazeni-vyleceni-umrti.json'],
+        'indexes': [[('datum', pymongo.ASCENDING), ('kraj_nuts_kod', pymongo.ASCENDING)]]},
+    {'name': 'ockovani_orp', 'builder': 'create_collection_ockovani_orp', 'sources': ['orp-ockovani-geografie.json'], 'delta': True,
+        'indexes': [[('orp_kod', pymongo.ASCENDING), ('datum', pymongo.ASCENDING)], [('orp_kod', pymongo.ASCENDING), ('rok', pymongo.ASCENDING), ('ctvrtleti', pymongo.ASCENDING)]]},
+    {'name': 'nakazeni_orp', 'builder': 'create_collection_nakazeni_orp', 'sources': ['obce-nakazeni.json'], 'delta': True,
+        'indexes': [[('orp_kod', pymongo.ASCENDING), ('datum', pymongo.ASCENDING)], [('orp_kod', pymongo.ASCENDING), ('rok', pymongo.ASCENDING), ('ctvrtleti', pymongo.ASCENDING)]]},
+    {'name': 'umrti_vek_okres_kraj', 'builder': 'create_collection_umrti_vek_okres_kraj', 'sources': ['kraj-okres-umrti.json'], 'delta': True, 'layout': 'raw',
+        'indexes': [[('vek', pymongo.ASCENDING)]]},
+    {'name': 'umrti_vek_okres_kraj_pocty', 'builder': 'create_collection_umrti_vek_okres_kraj_pocty', 'sources': ['kraj-okres-umrti.json'], 'delta': True, 'layout': 'histogram',
+        'schema': 'umrti_vek_okres_kraj',
+        'indexes': [[('vek', pymongo.ASCENDING)]]},
+    {'name': 'vyleceni_vek_okres_kraj', 'builder': 'create_collection_vyleceni_vek_okres_kraj', 'sources': ['kraj-okres-vyleceni.json'], 'delta': True, 'layout': 'raw'},
+    {'name': 'vyleceni_vek_okres_kraj_pocty', 'builder': 'create_collection_vyleceni_vek_okres_kraj_pocty', 'sources': ['kraj-okres-vyleceni.json'], 'delta': True, 'layout': 'histogram',
+        'schema': 'vyleceni_vek_okres_kraj'},
+    {'name': 'nakazeni-hospitalizovani-orp', 'builder': 'create_collection_nakazeni_hospitalizovani_orp', 'sources': ['orp-nakazeni-hospitalizovani.json'], 'delta': True},
+    {'name': 'obyvatele_orp', 'builder': 'create_collection_obyvatele_orp', 'sources': ['orp-populace.csv', 'orp-ciselnik.csv', 'vazba-orp-kraj.csv', 'kraj-ciselnik.csv', 'csu7700.csv']},
+    {'name': 'umrti_cr', 'builder': 'create_collection_umrti_cr', 'sources': ['cr-zemreli.csv'],
+        'indexes': [[('vek_kod', pymongo.ASCENDING), ('casref_od', pymongo.ASCENDING)]]},
+    {'name': 'nakazeni_orp_mesice', 'builder': 'create_collection_nakazeni_orp_mesice', 'sources': [], 'depends': ['nakazeni_orp'], 'buckets': True,
+        'indexes': [[('orp_kod', pymongo.ASCENDING), ('datum', pymongo.ASCENDING)]]},
+    {'name': 'ockovani_orp_mesice', 'builder': 'create_collection_ockovani_orp_mesice', 'sources': [], 'depends': ['ockovani_orp'], 'buckets': True,
+        'indexes': [[('orp_kod', pymongo.ASCENDING), ('datum', pymongo.ASCENDING)]]},
+    {'name': 'nakazeni-hospitalizovani-orp-mesice', 'builder': 'create_collection_nakazeni_hospitalizovani_orp_mesice', 'sources': [], 'depends': ['nakazeni-hospitalizovani-orp'], 'buckets': True,
+        'indexes': [[('orp_kod', pymongo.ASCENDING), ('datum', pymongo.ASCENDING)]]},
+    {'name': 'covid_po_obdobich_cr', 'builder': 'create_collection_covid_po_obdobich_cr', 'sources': [], 'depends': ['covid_po_dnech_cr'],
+        'indexes': [[('perioda', pymongo.ASCENDING), ('datum_od', pymongo.ASCENDING)]]},
+    {'name': 'nakazeni_po_obdobich_orp', 'builder': 'create_collection_nakazeni_po_obdobich_orp', 'sources': [], 'depends': ['nakazeni_orp'],
+        'indexes': [[('perioda', pymongo.ASCENDING), ('orp_kod', pymongo.ASCENDING), ('datum_od', pymongo.ASCENDING)]]},
+    {'name': 'ockovani_po_obdobich_orp', 'builder': 'create_collection_ockovani_po_obdobich_orp', 'sources': [], 'depends': ['ockovani_orp'],
+        'indexes': [[('perioda', pymongo.ASCENDING), ('orp_kod', pymongo.ASCENDING), ('datum_od', pymongo.ASCENDING)]]}
+]
+
+# documents of the collections created from dataset records, computed values are added to the records by the builders
+# (kod and nuts_kod of kraj, orp_kod and kraj_nuts_kod of ORP), histogram collections use the schema of the raw collection
+# fields read by the queries with $project and fields grouped in histograms are kept when null
+SCHEMAS: Dict[str, Schema] = {
+    'obyvatelstvo_kraj': Schema([
+        Field('hodnota', 'pocet', int_or_none, required=True),
+        Field('pohlavi_kod', converter=int_or_empty, required=True), # 1=muz, 2=zena
+        Field('vek_kod', required=True), # CSU7700
+        Field('vek_txt'),
+        Field('kod', required=True),
+        Field('nuts_kod', required=True),
+        Field('vuzemi_txt', 'nazev'),
+        Field('casref_do', converter=parse_date, required=True)
+    ]),
+    # outer join of three daily series, values of days missing in a series are left out
+    'covid_po_dnech_cr': Schema([Field('datum', converter=parse_date, required=True), *optional(
+        'AG_pozit_asymp_PCR_conf',
+        'AG_pozit_symp',
+        'PCR_pozit_asymp',
+        'PCR_pozit_sympt',
+        'ecmo',
+        'hfno',
+        'jip',
+        'kum_pacient_prvni_zaznam',
+        'kum_umrti',
+        'kumulativni_pocet_ag_testu',
+        'kumulativni_pocet_nakazenych',
+        'kumulativni_pocet_testu',
+        'kumulativni_pocet_umrti',
+        'kumulativni_pocet_vylecenych',
+        'kyslik',
+        'pacient_prvni_zaznam',
+        'pocet_hosp',
+        'pozit_typologie_test_indik_diagnosticka',
+        'pozit_typologie_test_indik_epidemiologicka',
+        'pozit_typologie_test_indik_ostatni',
+        'pozit_typologie_test_indik_preventivni',
+        'prirustkovy_pocet_nakazenych',
+        'prirustkovy_pocet_provedenych_ag_testu',
+        'prirustkovy_pocet_provedenych_testu',
+        'prirustkovy_pocet_umrti',
+        'prirustkovy_pocet_vylecenych',
+        'stav_bez_priznaku',
+        'stav_lehky',
+        'stav_stredni',
+        'stav_tezky',
+        'tezky_upv_ecmo',
+        'typologie_test_indik_diagnosticka',
+        'typologie_test_indik_epidemiologicka',
+        'typologie_test_indik_ostatni',
+        'typologie_test_indik_preventivni',
+        'umrti',
+        'upv'
+    )]),
+    'nakazeni_vek_okres_kraj': Schema([
+        Field('datum', converter=parse_date, required=True),
+        *nullable('vek', 'pohlavi', 'kraj_nuts_kod', 'okres_lau_kod', 'nakaza_v_zahranici', 'nakaza_zeme_csu_kod')
+    ]),
+    'umrti_vek_okres_kraj': Schema([
+        Field('datum', converter=parse_date, required=True),
+        *nullable('vek', 'pohlavi', 'kraj_nuts_kod', 'okres_lau_kod')
+    ]),
+    'vyleceni_vek_okres_kraj': Schema([
+        Field('datum', converter=parse_date, required=True),
+        *nullable('vek', 'pohlavi', 'kraj_nuts_kod', 'okres_lau_kod')
+    ]),
+    'nakazeni_vyleceni_umrti_testy_kraj': Schema([
+        Field('datum', converter=parse_date, required=True),
+        *nullable('kraj_nuts_kod', 'kumulativni_pocet_nakazenych', 'kumulativni_pocet_umrti', 'kumulativni_pocet_vylecenych'),
+        Field('kumulativni_pocet_prvnich_testu_kraj', 'kumulativni_pocet_prvnich_testu'),
+        Field('kumulativni_pocet_testu_kraj', 'kumulativni_pocet_testu'),
+        Field('prirustkovy_pocet_prvnich_testu_kraj', 'prirustkovy_pocet_prvnich_testu'),
+        Field('prirustkovy_pocet_testu_kraj', 'prirustkovy_pocet_testu')
+    ]),
+    'ockovani_orp': Schema([
+        Field('datum', converter=parse_date, required=True),
+        *nullable('orp_kod', 'orp_nazev', 'kraj_nuts_kod', 'kraj_nazev', 'pocet_davek')
+    ]),
+    'nakazeni_orp': Schema([
+        Field('datum', converter=parse_date, required=True),
+        *nullable(
+            'kraj_nuts_kod',
+            'kraj_nazev',
+            'okres_lau_kod',
+            'okres_nazev',
+            'orp_kod',
+            'orp_nazev',
+            'nove_pripady',
+            'aktivni_pripady',
+            'nove_pripady_65',
+            'nove_pripady_7_dni',
+            'nove_pripady_14_dni'
+        )
+    ]),
+    'nakazeni-hospitalizovani-orp': Schema([
+        Field('den'),
+        Field('datum', converter=parse_date, required=True),
+        *nullable(
+            'orp_kod',
+            'orp_nazev',
+            'incidence_7',
+            'incidence_65_7',
+            'incidence_75_7',
+            'prevalence',
+            'prevalence_65',
+            'prevalence_75',
+            'aktualni_pocet_hospitalizovanych_osob',
+            'nove_hosp_7',
+            'testy_7'
+        )
+    ]),
+    'umrti_cr': Schema([
+        Field('hodnota', 'pocet', int_or_none, required=True),
+        Field('vek_kod', required=True), # CSU 7700
+        Field('vek_txt'),
+        Field('casref_od', converter=parse_date, required=True),
+        Field('casref_do', converter=parse_date, required=True),
+        Field('priznak')
+    ]),
+    # records grouped by casref_do, orp_kod and pohlavi_kod, all fields are needed for the age groups
+    'obyvatele_orp': Schema([
+        Field('hodnota', 'pocet', int_or_none, required=True),
+        Field('pohlavi_kod', converter=int_or_empty, required=True), # 1=muz, 2=zena
+        Field('vek_kod', required=True), # CSU7700
+        Field('vek_txt', required=True),
+        Field('orp_kod', required=True),
+        Field('kraj_nuts_kod', required=True),
+        Field('vuzemi_txt', 'orp_nazev', required=True),
+        Field('casref_do', converter=parse_date, required=True)
+    ])
+}
+
+# records sent to an encoding worker at once
+ENCODE_BATCH_SIZE = 10000
+
+@lru_cache(maxsize=None)
+def compile_schema(name: str, projection: Union[Tuple[str, ...], None] = None) -> Callable[[dict], dict]:
+    """Transformation of records to documents of the collection, compiled once per process"""
+    return SCHEMAS[name].project(projection).compile()
+
+def encode_records(
+    name: str,
+    projection: Union[Tuple[str, ...], None],
+    records: List[dict],
+    field: str = 'datum',
+    first_id: Union[int, None] = None
+) -> List[bytes]:
+    """Documents of the collection with calendar fields encoded to BSON, used by the encoding worker processes
+        With first_id the documents get _id by their position in the input"""
+    transform = compile_schema(name, projection)
+    encoded = []
+    for i, record in enumerate(records):
+        doc = transform(record)
+        doc.update(get_calendar_fields(doc[field]))
+        if first_id is not None:
+            doc['_id'] = first_id + i
+        encoded.append(bson.encode(doc))
+
+    return encoded
+
+def encode_chunk(records: List[dict], name: str, projection: Union[Tuple[str, ...], None], field: str = 'datum') -> List[bytes]:
+    """encode_records for chunks of records decoded by the JSON decoding workers"""
+    return encode_records(name, projection, records, field)
+
+def code_names(code) -> Iterator[str]:
+    """Global and attribute names used by the code, including nested functions and comprehensions"""
+    yield from code.co_names
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            yield from code_names(const)
+
+@lru_cache(maxsize=None)
+def get_code_sources(func: Callable) -> Tuple[str, ...]:
+    """Source code of the function and of the functions and classes of this package it uses, found by the names
+        in its code (methods by the attribute names on DBC), so a change of a helper changes the definition hash"""
+    package = __name__.rpartition('.')[0] + '.'
+    sources = {}
+    pending = [func]
+    while pending:
+        obj = pending.pop()
+        key = '%s.%s' % (obj.__module__, obj.__qualname__)
+        if key in sources:
+            continue
+        sources[key] = inspect.getsource(obj)
+
+        functions = [obj] if not inspect.isclass(obj) else [getattr(value, '__func__', value) for value in vars(obj).values()]
+        for function in filter(inspect.isfunction, functions):
+            for name in code_names(function.__code__):
+                for candidate in (getattr(DBC, name, None), function.__globals__.get(name)):
+                    # cached functions (lru_cache) are wrappers of the function
+                    candidate = inspect.unwrap(candidate) if callable(candidate) else candidate
+                    # DBC itself would make every collection depend on all the builders
+                    if (inspect.isfunction(candidate) or inspect.isclass(candidate)) and candidate is not DBC \
+                            and getattr(candidate, '__module__', '').startswith(package):
+                        pending.append(candidate)
+
+    return tuple(sources[key] for key in sorted(sources))
+
+class DBCException(Exception):
+    def __init__(self, message: str = ''):
+        super().__init__(message)
+
+def build_collection(settings: dict, name: str) -> str:
+    """Create a single collection with a new connection, used by the worker processes"""
+    dbc = DBC(**settings)
+    dbc.create_collection(name)
+    return name
 
 class DBC:
     DB_NAME = 'covid'
     DEFAULT_HOST = 'localhost'
     DEFAULT_PORT = 27017
-
-    def __init__(self, host: str = 'localhost', port: int = 27017, timeout: Union[int, None] = None) -> None:
+    STAGING_PREFIX = 'staging_'
+    # hashes of the inputs each collection was built from and watermarks of delta ingestion
+    META_COLLECTION = 'metadata'
+    # days before the watermark that are replaced by delta ingestion, MZCR revises recent days
+    DEFAULT_DELTA_DAYS = 7
+    # progress of builds inserting documents in chunks, see DBC.insert_records
+    CHECKPOINT_COLLECTION = 'checkpoints'
+    CHECKPOINT_CHUNK_SIZE = 100000
+
+    # off - raw per person collections, add - raw and histogram collections, replace - histogram collections only
+    HISTOGRAMS = ('off', 'add', 'replace')
+
+    def __init__(
+        self,
+        host: str = 'localhost',
+        port: int = 27017,
+        timeout: Union[int, None] = None,
+        batch_size: Union[int, None] = None,
+        bypass_validation: bool = False,
+        log: bool = False,
+        memory_budget: Union[int, None] = DEFAULT_MEMORY_BUDGET,
+        staging: bool = False,
+        histograms: str = 'off',
+        buckets: bool = False,
+        projections: Union[Dict[str, List[str]], None] = None,
+        encoders: int = 1,
+        delta_days: int = DEFAULT_DELTA_DAYS,
+        checkpoints: bool = False,
+        pipeline: bool = False,
+        json_workers: int = 1,
+        json_backend: Union[str, None] = None
+    ) -> None:
         self.conn = None
         self.db = None
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.bypass_validation = bypass_validation
+        self.log = log
+        self.memory_budget = memory_budget
+        self.staging = staging
+        self.histograms = histograms
+        self.buckets = buckets
+        self.projections = projections if projections is not None else {}
+        unknown = set(self.projections).difference(SCHEMAS)
+        if unknown:
+            raise DBCException('Projection of collections without schema (%s)' % ', '.join(sorted(unknown)))
+        self.encoders = encoders
+        self.delta_days = delta_days
+        # set while a collection is ingested incrementally, only records dated from it are inserted
+        self.delta_since: Union[datetime, None] = None
+        self.checkpoints = checkpoints
+        # hashes of the inputs of the collections being built, checkpoints are valid only for the same inputs
+        self.build_hashes: Dict[str, str] = {}
+        self.pipeline = pipeline
+        check_backend(json_backend)
+        self.json_workers = json_workers
+        self.json_backend = json_backend
         self.connect(host, port, timeout)
 
         self.version = self.get_version()
@@ -60,491 +387,403 @@ class DBC:
 
         return coll
 
-    def get_version(self) -> Tuple[str]:
-        version = self.conn.server_info()['version']
-        return tuple(version.split('.'))
+    def use_staging(self) -> bool:
+        # delta ingestion appends to the existing collection
+        return self.staging and self.delta_since is None
 
-    def check_version(self, version: str) -> bool:
-        req = tuple(version.split('.'))
-        return (req <= self.version)
+    def get_build_name(self, name: str) -> str:
+        return DBC.STAGING_PREFIX + name if self.use_staging() else name
 
-    def create_collection_obyvatelstvo_kraj(self) -> None:
-        coll = self.get_collection('obyvatelstvo_kraj')
+    def get_build_collection(self, name: str) -> Collection:
+        """Collection the builder inserts into, dropped first (including a staging collection left from a failed rebuild)
+            unless documents are appended to it by delta ingestion or a resumed build"""
+        drop = self.delta_since is None and self.get_checkpoint(name) is None
+        return self.get_collection(self.get_build_name(name), drop=drop)
 
-        kraje = Kraje()
+    def swap_collection(self, name: str) -> None:
+        """Replace the collection with its staging collection, renameCollection with dropTarget is atomic for readers"""
+        if not self.use_staging():
+            return
+
+        build_name = self.get_build_name(name)
+        if not self.has_collection(build_name):
+            # the builder inserted nothing and the collection has no indexes, so it was never created
+            self.db.create_collection(build_name)
 
-        min_datum = DateParser.parse('2018-01-01')
-        document = []
+        self.get_collection(build_name).rename(name, dropTarget=True)
 
-        with open('%s/%s' % (DATA_PATH, 'kraj-okres-obyvatelstvo.csv'), 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
+        if self.log:
+            print('%s:\tstaging collection renamed' % name, flush=True)
 
-            for data in reader:
-                casref_do = DateParser.parse(data['casref_do'])
-                vuzemi_cis = int(data['vuzemi_cis']) if data['vuzemi_cis'] else None
-                if vuzemi_cis == UZEMI_KRAJ and casref_do > min_datum:
-                    try:
-                        kod = int(data['vuzemi_kod'])
-                    except:
-                        kod = ''
-                    nuts = kraje.get_nuts(kod)
-                    document.append(self.create_record_obyvatelstvo_kraj(data, casref_do, kod, nuts))
+    def get_version(self) -> Tuple[str]:
+        version = self.conn.server_info()['version']
+        return tuple(version.split('.'))
 
-        coll.insert_many(document)
+    def check_version(self, version: str) -> bool:
+        req = tuple(version.split('.'))
+        return (req <= self.version)
 
-    def create_record_obyvatelstvo_kraj(self, data: OrderedDict, casref_do, kod, nuts) -> dict:
+    def get_settings(self) -> dict:
         return {
-            'pocet': int(data['hodnota']) if data['hodnota'] else None,
-            'pohlavi_kod': int(data['pohlavi_kod']) if data['pohlavi_kod'] else '', # 1=muz, 2=zena
-            'vek_kod': data['vek_kod'], # CSU7700
-            'vek_txt': data['vek_txt'],
-            'kod': kod,
-            'nuts_kod': nuts,
-            'nazev': data['vuzemi_txt'],
-            'casref_do': casref_do
+            'host': self.host,
+            'port': self.port,
+            'timeout': self.timeout,
+            'batch_size': self.batch_size,
+            'bypass_validation': self.bypass_validation,
+            'log': self.log,
+            'memory_budget': self.memory_budget,
+            'staging': self.staging,
+            'histograms': self.histograms,
+            'buckets': self.buckets,
+            'projections': self.projections,
+            'encoders': self.encoders,
+            'delta_days': self.delta_days,
+            'checkpoints': self.checkpoints,
+            'pipeline': self.pipeline,
+            'json_workers': self.json_workers,
+            'json_backend': self.json_backend
         }
 
-    def create_collection_covid_po_dnech_cr(self) -> None:
-        coll = self.get_collection('covid_po_dnech_cr')
+    def get_bulk_writer(self, coll: Collection) -> BulkWriter:
+        # with pipeline a chunk is inserted while the next one is collected
+        return BulkWriter(coll, self.batch_size, bypass_validation=self.bypass_validation, log=self.log, background=self.pipeline)
+
+    def stage(self, iterable: Iterable) -> Iterable:
+        """With pipeline the iterable is consumed by its own thread, so it runs concurrently with the next stage"""
+        return pipelined(iterable) if self.pipeline else iterable
+
+    def insert_documents(self, coll: Collection, documents: Iterable[dict]) -> int:
+        """Insert documents with the bulk writer, with pipeline the documents are read and created in a thread
+            while the previous batches are inserted"""
+        return self.get_bulk_writer(coll).write(self.stage(documents))
+
+    def add_calendar_fields(self, documents: Iterable[dict], field: str = 'datum') -> Iterator[dict]:
+        """Add rok, mesic, ctvrtleti, iso_rok, iso_tyden and den_index of the date in field to the documents"""
+        for doc in documents:
+            doc.update(get_calendar_fields(doc[field]))
+            yield doc
+
+    def get_projection(self, name: str) -> Union[Tuple[str, ...], None]:
+        projection = self.projections.get(name, None)
+        return tuple(projection) if projection is not None else None
+
+    def get_schema(self, name: str) -> Schema:
+        """Schema of the collection with only the fields selected in projections (and the required ones)"""
+        return SCHEMAS[name].project(self.get_projection(name))
+
+    def get_transformer(self, name: str) -> Callable[[dict], dict]:
+        """Compiled function creating a document of the collection from a record"""
+        return compile_schema(name, self.get_projection(name))
+
+    def read_dataset(self, name: str) -> Iterator[dict]:
+        """Records of a downloaded JSON dataset, with json_workers > 1 decoded in chunks by a process pool"""
+        if self.json_workers > 1:
+            return self.read_chunks(name, map_json_data(name, workers=self.json_workers, backend=self.json_backend), lambda records: records)
+
+        return read_json_data(name)
+
+    def read_chunks(self, name: str, chunks: Iterable[list], fallback: Callable[[Iterable[dict]], Iterable]) -> Iterator:
+        """Items of the chunks of the JSON dataset decoded by the worker processes, one item per record
+            A chunk that does not decode (a string value containing a record boundary) does not abort the build,
+            the remaining records are read by read_json_data and passed through fallback instead"""
+        done = 0
+        try:
+            for chunk in chunks:
+                yield from chunk
+                done += len(chunk)
+        except JSONStreamError as exc:
+            if self.log:
+                print('%s:\tdecoding in chunks failed after %i records, read sequentially (%s)' % (name, done, exc), flush=True)
+
+            # read_json_data yields the records in the same order, the ones already yielded are skipped
+            yield from fallback(islice(read_json_data(name), done, None))
+
+    def insert_dataset(self, coll: Collection, name: str, dataset: str, field: str = 'datum') -> int:
+        """Insert documents of the collection created from all records of the JSON dataset
+            With json_workers > 1 or encoders > 1 the worker processes read and decode byte ranges of the dataset themselves,
+            create the documents and encode them to BSON, only the raw BSON documents are sent back
+            (delta ingestion and checkpoints read the records in this process)"""
+        workers = max(self.json_workers, self.encoders)
+        if workers <= 1 or self.delta_since is not None or self.checkpoints:
+            return self.insert_records(coll, name, self.read_delta(self.read_dataset(dataset)), field)
+
+        chunks = map_json_data(dataset, encode_chunk, (name, self.get_projection(name), field), workers, self.json_backend)
+        documents = self.read_chunks(
+            dataset,
+            ([RawBSONDocument(doc) for doc in chunk] for chunk in chunks),
+            lambda records: self.transform_documents(name, records, field)
+        )
+        return self.insert_documents(coll, documents)
+
+    def read_delta(self, records: Iterable[dict]) -> Iterable[dict]:
+        """Records dated on or after delta_since during delta ingestion, all records otherwise"""
+        if self.delta_since is None:
+            return records
+
+        return (record for record in records if parse_date(record['datum']) >= self.delta_since)
+
+    def transform_documents(self, name: str, records: Iterable[dict], field: str = 'datum', first_id: Union[int, None] = None) -> Iterator:
+        """Documents of the collection created from the records, with calendar fields of the date in field
+            With encoders > 1 the documents are created and encoded to BSON by worker processes, the records are still
+            parsed by this process and pickled to the workers, which costs about as much as encoding them, so this alone
+            does not scale with cores (collections created directly from a dataset use insert_dataset instead)
+            With first_id the documents get _id by their position in the records"""
+        if self.encoders <= 1:
+            documents = self.add_calendar_fields(map(self.get_transformer(name), records), field)
+            return documents if first_id is None else self.add_ids(documents, first_id)
+
+        return self.encode_documents(name, records, field, first_id)
+
+    def add_ids(self, documents: Iterable[dict], first_id: int) -> Iterator[dict]:
+        for i, doc in enumerate(documents, first_id):
+            doc['_id'] = i
+            yield doc
+
+    def encode_documents(self, name: str, records: Iterable[dict], field: str = 'datum', first_id: Union[int, None] = None) -> Iterator[RawBSONDocument]:
+        projection = self.get_projection(name)
+        pending = deque()
+
+        with ProcessPoolExecutor(max_workers=self.encoders) as executor:
+            for batch in batched(records, ENCODE_BATCH_SIZE):
+                pending.append(executor.submit(encode_records, name, projection, batch, field, first_id))
+                if first_id is not None:
+                    first_id += len(batch)
+
+                # batches in flight are limited, results are read in the order of the records
+                if len(pending) >= 2 * self.encoders:
+                    yield from map(RawBSONDocument, pending.popleft().result())
+
+            while pending:
+                yield from map(RawBSONDocument, pending.popleft().result())
+
+    def get_checkpoint(self, name: str) -> Union[dict, None]:
+        """Last committed chunk of an interrupted build of the collection from the same inputs
+            A checkpoint without the collection it was written for (e.g. already swapped) is not resumed"""
+        if not self.checkpoints or name not in self.build_hashes or not self.has_collection(self.get_build_name(name)):
+            return None
+
+        return self.get_collection(DBC.CHECKPOINT_COLLECTION).find_one({'_id': name, 'hash': self.build_hashes[name]})
+
+    def insert_records(self, coll: Collection, name: str, records: Iterable[dict], field: str = 'datum') -> int:
+        """Insert documents of the collection created from the records (see transform_documents)
+            With checkpoints the documents are inserted in chunks of CHECKPOINT_CHUNK_SIZE records with _id set to
+            the position of the record in the input and the checkpoint is updated after each chunk
+            A resumed build skips the committed records and deletes documents of the chunk that was not committed,
+            so writing a chunk again does not create duplicates
+            The records have to come in the same order for the same inputs, e.g. a dataset or grouped records (sorted by key)
+            With pipeline parsing of the records and creating the documents run in separate threads"""
+        records = self.stage(records)
+        if not self.checkpoints or self.delta_since is not None:
+            return self.insert_documents(coll, self.transform_documents(name, records, field))
+
+        checkpoint = self.get_checkpoint(name)
+        offset = checkpoint['offset'] if checkpoint is not None else 0
+        inserted = checkpoint['inserted'] if checkpoint is not None else 0
+
+        if offset:
+            deleted = coll.delete_many({'_id': {'$gte': offset}}).deleted_count
+            if self.log:
+                print('%s:\tresumed after chunk %i (%i records, %i uncommitted documents deleted)' % (name, checkpoint['chunk'], offset, deleted), flush=True)
+
+        writer = self.get_bulk_writer(coll)
+        checkpoints = self.get_collection(DBC.CHECKPOINT_COLLECTION)
+        for chunk in batched(islice(records, offset, None), DBC.CHECKPOINT_CHUNK_SIZE):
+            inserted += writer.write(self.stage(self.transform_documents(name, chunk, field, offset)))
+            offset += len(chunk)
+
+            checkpoints.replace_one({'_id': name}, {
+                '_id': name,
+                'hash': self.build_hashes[name],
+                'chunk': (offset - 1) // DBC.CHECKPOINT_CHUNK_SIZE,
+                'offset': offset,
+                'inserted': inserted,
+                'zapsano': datetime.now()
+            }, upsert=True)
+
+        return inserted
+
+    def project_reducers(self, name: str, reducers: dict) -> dict:
+        """Reducers of fields used by the schema of the collection, other fields are not aggregated at all"""
+        sources = set(self.get_schema(name).sources)
+        return {field: reducer for field, reducer in reducers.items() if field in sources}
 
-        document = []
+    def create_collection_obyvatelstvo_kraj(self) -> None:
+        coll = self.get_build_collection('obyvatelstvo_kraj')
 
-        with open('%s/%s' % (DATA_PATH, 'cr-hospitalizace-umrti.json'), 'r') as file:
-            hospitalizace = json.load(file)['data']
+        self.insert_documents(coll, self.add_calendar_fields(self.read_obyvatelstvo_kraj(), 'casref_do'))
 
-        with open('%s/%s' % (DATA_PATH, 'cr-nakazeni-vyleceni-umrti-testy.json'), 'r') as file:
-            nakazeni = json.load(file)['data']
+    def read_obyvatelstvo_kraj(self) -> Iterator[dict]:
+        kraje = Kraje()
 
-        with open('%s/%s' % (DATA_PATH, 'cr-testy.json'), 'r') as file:
-            testy = json.load(file)['data']
+        min_datum = parse_date('2018-01-01')
 
-        l1 = [{**i1, **i2} for i1, i2 in mergeListsByKey(hospitalizace, nakazeni, key="datum")]
-        l2 = [{**i1, **i2} for i1, i2 in mergeListsByKey(l1, testy, key="datum")]
+        transform = self.get_transformer('obyvatelstvo_kraj')
+        fields = ['vuzemi_cis', 'vuzemi_kod', 'casref_do', *self.get_schema('obyvatelstvo_kraj').sources]
 
-        for data in l2:
-            document.append(self.create_record_covid_po_dnech_cr(data))
+        for data in read_csv_data('kraj-okres-obyvatelstvo.csv', fields):
+            casref_do = parse_date(data['casref_do'])
+            vuzemi_cis = int(data['vuzemi_cis']) if data['vuzemi_cis'] else None
+            if vuzemi_cis == UZEMI_KRAJ and casref_do > min_datum:
+                try:
+                    kod = int(data['vuzemi_kod'])
+                except:
+                    kod = ''
+                data['kod'] = kod
+                data['nuts_kod'] = kraje.get_nuts(kod)
+                yield transform(data)
 
-        coll.insert_many(document)
+    def create_collection_covid_po_dnech_cr(self) -> None:
+        coll = self.get_build_collection('covid_po_dnech_cr')
 
-    def create_record_covid_po_dnech_cr(self, data: dict) -> dict:
-        return {
-            'datum': DateParser.parse(data['datum']),
-            'AG_pozit_asymp_PCR_conf': data.get('AG_pozit_asymp_PCR_conf', None),
-            'AG_pozit_symp': data.get('AG_pozit_symp', None),
-            'PCR_pozit_asymp': data.get('PCR_pozit_asymp', None),
-            'PCR_pozit_sympt': data.get('PCR_pozit_sympt', None),
-            'ecmo': data.get('ecmo', None),
-            'hfno': data.get('hfno', None),
-            'jip': data.get('jip', None),
-            'kum_pacient_prvni_zaznam': data.get('kum_pacient_prvni_zaznam', None),
-            'kum_umrti': data.get('kum_umrti', None),
-            'kumulativni_pocet_ag_testu': data.get('kumulativni_pocet_ag_testu', None),
-            'kumulativni_pocet_nakazenych': data.get('kumulativni_pocet_nakazenych', None),
-            'kumulativni_pocet_testu': data.get('kumulativni_pocet_testu', None),
-            'kumulativni_pocet_umrti': data.get('kumulativni_pocet_umrti', None),
-            'kumulativni_pocet_vylecenych': data.get('kumulativni_pocet_vylecenych', None),
-            'kyslik': data.get('kyslik', None),
-            'pacient_prvni_zaznam': data.get('pacient_prvni_zaznam', None),
-            'pocet_hosp': data.get('pocet_hosp', None),
-            'pozit_typologie_test_indik_diagnosticka': data.get('pozit_typologie_test_indik_diagnosticka', None),
-            'pozit_typologie_test_indik_epidemiologicka': data.get('pozit_typologie_test_indik_epidemiologicka', None),
-            'pozit_typologie_test_indik_ostatni': data.get('pozit_typologie_test_indik_ostatni', None),
-            'pozit_typologie_test_indik_preventivni': data.get('pozit_typologie_test_indik_preventivni', None),
-            'prirustkovy_pocet_nakazenych': data.get('prirustkovy_pocet_nakazenych', None),
-            'prirustkovy_pocet_provedenych_ag_testu': data.get('prirustkovy_pocet_provedenych_ag_testu', None),
-            'prirustkovy_pocet_provedenych_testu': data.get('prirustkovy_pocet_provedenych_testu', None),
-            'prirustkovy_pocet_umrti': data.get('prirustkovy_pocet_umrti', None),
-            'prirustkovy_pocet_vylecenych': data.get('prirustkovy_pocet_vylecenych', None),
-            'stav_bez_priznaku': data.get('stav_bez_priznaku', None),
-            'stav_lehky': data.get('stav_lehky', None),
-            'stav_stredni': data.get('stav_stredni', None),
-            'stav_tezky': data.get('stav_tezky', None),
-            'tezky_upv_ecmo': data.get('tezky_upv_ecmo', None),
-            'typologie_test_indik_diagnosticka': data.get('typologie_test_indik_diagnosticka', None),
-            'typologie_test_indik_epidemiologicka': data.get('typologie_test_indik_epidemiologicka', None),
-            'typologie_test_indik_ostatni': data.get('typologie_test_indik_ostatni', None),
-            'typologie_test_indik_preventivni': data.get('typologie_test_indik_preventivni', None),
-            'umrti': data.get('umrti', None),
-            'upv': data.get('upv', None)
-        }
+        # the order of the daily series is not guaranteed, each has one record per day, so the join is done in a dict
+        hospitalizace = self.read_delta(self.read_dataset('cr-hospitalizace-umrti.json'))
+        nakazeni = self.read_delta(self.read_dataset('cr-nakazeni-vyleceni-umrti-testy.json'))
+        testy = self.read_delta(self.read_dataset('cr-testy.json'))
 
-    def create_collection_nakazeni_vek_okres_kraj(self) -> None:
-        coll = self.get_collection('nakazeni_vek_okres_kraj')
+        l = hash_join(hospitalizace, nakazeni, testy, key='datum')
 
-        document = []
+        self.insert_records(coll, 'covid_po_dnech_cr', l)
 
-        with open('%s/%s' % (DATA_PATH, 'kraj-okres-nakazeni.json'), 'r') as file:
-            json_data = json.load(file)['data']
+    def create_collection_nakazeni_vek_okres_kraj(self) -> None:
+        coll = self.get_build_collection('nakazeni_vek_okres_kraj')
 
-        for data in json_data:
-            document.append(self.create_record_nakazeni_vek_okres_kraj(data))
+        self.insert_dataset(coll, 'nakazeni_vek_okres_kraj', 'kraj-okres-nakazeni.json')
 
-        coll.insert_many(document)
+    def create_histogram(self, name: str, records: Iterable[dict], key: Tuple[str, ...]) -> None:
+        """Store distinct records (by key fields) once with the number of occurrences in pocet"""
+        coll = self.get_build_collection(name)
 
-    def create_record_nakazeni_vek_okres_kraj(self, data: dict) -> dict:
-        return {
-            'datum': DateParser.parse(data['datum']),
-            'vek': data.get('vek', None),
-            'pohlavi': data.get('pohlavi', None),
-            'kraj_nuts_kod': data.get('kraj_nuts_kod', None),
-            'okres_lau_kod': data.get('okres_lau_kod', None),
-            'nakaza_v_zahranici': data.get('nakaza_v_zahranici', None),
-            'nakaza_zeme_csu_kod': data.get('nakaza_zeme_csu_kod', None)
-        }
+        histogram = group_by(records, key, {'pocet': Count()}, memory_budget=self.memory_budget)
 
-    def create_collection_umrti_vek_okres_kraj(self) -> None:
-        coll = self.get_collection('umrti_vek_okres_kraj')
+        self.insert_documents(coll, self.add_calendar_fields(histogram))
 
-        document = []
+    def create_collection_nakazeni_vek_okres_kraj_pocty(self) -> None:
+        json_data = self.read_delta(self.read_dataset('kraj-okres-nakazeni.json'))
 
-        with open('%s/%s' % (DATA_PATH, 'kraj-okres-umrti.json'), 'r') as file:
-            json_data = json.load(file)['data']
+        self.create_histogram(
+            'nakazeni_vek_okres_kraj_pocty',
+            map(self.get_transformer('nakazeni_vek_okres_kraj'), json_data),
+            tuple(self.get_schema('nakazeni_vek_okres_kraj').targets)
+        )
 
-        for data in json_data:
-            document.append(self.create_record_umrti_vek_okres_kraj(data))
+    def create_collection_umrti_vek_okres_kraj(self) -> None:
+        coll = self.get_build_collection('umrti_vek_okres_kraj')
 
-        coll.insert_many(document)
+        self.insert_dataset(coll, 'umrti_vek_okres_kraj', 'kraj-okres-umrti.json')
 
-    def create_record_umrti_vek_okres_kraj(self, data: dict) -> dict:
-        return {
-            'datum': DateParser.parse(data['datum']),
-            'vek': data.get('vek', None),
-            'pohlavi': data.get('pohlavi', None),
-            'kraj_nuts_kod': data.get('kraj_nuts_kod', None),
-            'okres_lau_kod': data.get('okres_lau_kod', None)
-        }
+    def create_collection_umrti_vek_okres_kraj_pocty(self) -> None:
+        json_data = self.read_delta(self.read_dataset('kraj-okres-umrti.json'))
+
+        self.create_histogram(
+            'umrti_vek_okres_kraj_pocty',
+            map(self.get_transformer('umrti_vek_okres_kraj'), json_data),
+            tuple(self.get_schema('umrti_vek_okres_kraj').targets)
+        )
 
     def create_collection_vyleceni_vek_okres_kraj(self) -> None:
-        coll = self.get_collection('vyleceni_vek_okres_kraj')
+        coll = self.get_build_collection('vyleceni_vek_okres_kraj')
 
-        document = []
+        self.insert_dataset(coll, 'vyleceni_vek_okres_kraj', 'kraj-okres-vyleceni.json')
 
-        with open('%s/%s' % (DATA_PATH, 'kraj-okres-vyleceni.json'), 'r') as file:
-            json_data = json.load(file)['data']
+    def create_collection_vyleceni_vek_okres_kraj_pocty(self) -> None:
+        json_data = self.read_delta(self.read_dataset('kraj-okres-vyleceni.json'))
 
-        for data in json_data:
-            document.append(self.create_record_vyleceni_vek_okres_kraj(data))
+        self.create_histogram(
+            'vyleceni_vek_okres_kraj_pocty',
+            map(self.get_transformer('vyleceni_vek_okres_kraj'), json_data),
+            tuple(self.get_schema('vyleceni_vek_okres_kraj').targets)
+        )
 
-        coll.insert_many(document)
+    def create_collection_nakazeni_vyleceni_umrti_testy_kraj(self) -> None:
+        coll = self.get_build_collection('nakazeni_vyleceni_umrti_testy_kraj')
 
-    def create_record_vyleceni_vek_okres_kraj(self, data: dict) -> dict:
-        return {
-            'datum': DateParser.parse(data['datum']),
-            'vek': data.get('vek', None),
-            'pohlavi': data.get('pohlavi', None),
-            'kraj_nuts_kod': data.get('kraj_nuts_kod', None),
-            'okres_lau_kod': data.get('okres_lau_kod', None)
-        }
+        # values for kraj are repeated for each okres, first record is used
+        testy_merged = group_by(self.read_dataset('kraj-okres-testy.json'), ('datum', 'kraj_nuts_kod'), self.project_reducers('nakazeni_vyleceni_umrti_testy_kraj', {
+            'kumulativni_pocet_prvnich_testu_kraj': First('kumulativni_pocet_prvnich_testu_kraj'),
+            'kumulativni_pocet_testu_kraj': First('kumulativni_pocet_testu_kraj'),
+            'prirustkovy_pocet_prvnich_testu_kraj': First('prirustkovy_pocet_prvnich_testu_kraj'),
+            'prirustkovy_pocet_testu_kraj': First('prirustkovy_pocet_testu_kraj')
+        }), memory_budget=self.memory_budget)
 
-    def create_collection_nakazeni_vyleceni_umrti_testy_kraj(self) -> None:
-        coll = self.get_collection('nakazeni_vyleceni_umrti_testy_kraj')
-
-        document = []
-
-        with open('%s/%s' % (DATA_PATH, 'kraj-okres-testy.json'), 'r') as file:
-            testy = json.load(file)['data']
-
-        testy = sorted(testy, key=lambda x: (x['datum'], x['kraj_nuts_kod']))
-
-        datum = ''
-        kraj = ''
-        testy_merged = []
-        for data in testy:
-            if data['datum'] != datum or data['kraj_nuts_kod'] != kraj:
-                testy_merged.append(data)
-                datum = data['datum']
-                kraj = data['kraj_nuts_kod']
-
-        with open('%s/%s' % (DATA_PATH, 'kraj-okres-nakazeni-vyleceni-umrti.json'), 'r') as file:
-            nakazeni_vyleceni_umrti = json.load(file)['data']
-
-        nakazeni_vyleceni_umrti = [i for i in nakazeni_vyleceni_umrti if i['kraj_nuts_kod']]
-
-        nakazeni_vyleceni_umrti = sorted(nakazeni_vyleceni_umrti, key=lambda x: (x['datum'], x['kraj_nuts_kod']))
-
-        datum = nakazeni_vyleceni_umrti[0]['datum']
-        kraj = nakazeni_vyleceni_umrti[0]['kraj_nuts_kod']
-        nakazeni = 0
-        vyleceni = 0
-        umrti = 0
-        nakazeni_vyleceni_umrti_merged = []
-        for data in nakazeni_vyleceni_umrti:
-            if data['datum'] != datum or data['kraj_nuts_kod'] != kraj:
-                nakazeni_vyleceni_umrti_merged.append({
-                    "datum": datum,
-                    "kraj_nuts_kod": kraj,
-                    "kumulativni_pocet_nakazenych": nakazeni,
-                    "kumulativni_pocet_vylecenych": vyleceni,
-                    "kumulativni_pocet_umrti": umrti
-                })
-                datum = data['datum']
-                kraj = data['kraj_nuts_kod']
-                nakazeni = data['kumulativni_pocet_nakazenych']
-                vyleceni = data['kumulativni_pocet_vylecenych']
-                umrti = data['kumulativni_pocet_umrti']
-            else:
-                nakazeni += data['kumulativni_pocet_nakazenych']
-                vyleceni += data['kumulativni_pocet_vylecenych']
-                umrti += data['kumulativni_pocet_umrti']
-
-        nakazeni_vyleceni_umrti_merged.append({
-            "datum": datum,
-            "kraj_nuts_kod": kraj,
-            "kumulativni_pocet_nakazenych": nakazeni,
-            "kumulativni_pocet_vylecenych": vyleceni,
-            "kumulativni_pocet_umrti": umrti
-        })
-
-        l = [{**i1, **i2} for i1, i2 in mergeListsByTwoKeys(testy_merged, nakazeni_vyleceni_umrti_merged, key1="datum", key2="kraj_nuts_kod")]
-
-        for data in l:
-            document.append(self.create_record_nakazeni_vyleceni_umrti_testy_kraj(data))
-
-        coll.insert_many(document)
-
-    def create_record_nakazeni_vyleceni_umrti_testy_kraj(self, data: dict) -> dict:
-        return {
-            'datum': DateParser.parse(data['datum']),
-            'kraj_nuts_kod': data.get('kraj_nuts_kod', None),
-            'kumulativni_pocet_nakazenych': data.get('kumulativni_pocet_nakazenych', None),
-            'kumulativni_pocet_umrti': data.get('kumulativni_pocet_umrti', None),
-            'kumulativni_pocet_vylecenych': data.get('kumulativni_pocet_vylecenych', None),
-            'kumulativni_pocet_prvnich_testu': data.get('kumulativni_pocet_prvnich_testu_kraj', None),
-            'kumulativni_pocet_testu': data.get('kumulativni_pocet_testu_kraj', None),
-            'prirustkovy_pocet_prvnich_testu': data.get('prirustkovy_pocet_prvnich_testu_kraj', None),
-            'prirustkovy_pocet_testu': data.get('prirustkovy_pocet_testu_kraj', None)
-        }
+        nakazeni_vyleceni_umrti = (i for i in self.read_dataset('kraj-okres-nakazeni-vyleceni-umrti.json') if i['kraj_nuts_kod'])
+        nakazeni_vyleceni_umrti_merged = group_by(nakazeni_vyleceni_umrti, ('datum', 'kraj_nuts_kod'), self.project_reducers('nakazeni_vyleceni_umrti_testy_kraj', {
+            'kumulativni_pocet_nakazenych': Sum('kumulativni_pocet_nakazenych'),
+            'kumulativni_pocet_vylecenych': Sum('kumulativni_pocet_vylecenych'),
+            'kumulativni_pocet_umrti': Sum('kumulativni_pocet_umrti')
+        }), memory_budget=self.memory_budget)
 
-    def create_collection_ockovani_orp(self) -> None:
-        coll = self.get_collection('ockovani_orp')
-
-        document = []
-
-        with open('%s/%s' % (DATA_PATH, 'orp-ockovani-geografie.json'), 'r', encoding='utf-8') as file:
-            ockovani = json.load(file)['data']
-
-        ockovani = [i for i in ockovani if i['orp_bydliste_kod']]
-
-        ockovani = sorted(ockovani, key=lambda x: (x['datum'], x['orp_bydliste_kod']))
-
-        datum = ockovani[0]['datum']
-        orp = ockovani[0]['orp_bydliste_kod']
-        orp_nazev = ockovani[0]['orp_bydliste']
-        kraj = ockovani[0]['kraj_nazev']
-        nuts = ockovani[0]['kraj_nuts_kod']
-        pocet = 0
-        ockovani_merged = []
-        for data in ockovani:
-            if data['datum'] != datum or data['orp_bydliste_kod'] != orp:
-                ockovani_merged.append({
-                    "datum": datum,
-                    "kraj_nuts_kod": nuts,
-                    "kraj_nazev": kraj,
-                    "orp_kod": orp,
-                    "pocet_davek": pocet,
-                    "orp_nazev": orp_nazev
-                })
-                datum = data['datum']
-                orp = data['orp_bydliste_kod']
-                kraj = data['kraj_nazev']
-                nuts = data['kraj_nuts_kod']
-                orp_nazev = data['orp_bydliste']
-                pocet = data['pocet_davek']
-            else:
-                pocet += data['pocet_davek']
-
-        ockovani_merged.append({
-            "datum": datum,
-            "kraj_nuts_kod": nuts,
-            "kraj_nazev": kraj,
-            "orp_kod": orp,
-            "pocet_davek": pocet,
-            "orp_nazev": orp_nazev
-        })
-
-        for data in ockovani_merged:
-            document.append(self.create_record_ockovani_orp(data))
-
-        coll.insert_many(document)
-
-    def create_record_ockovani_orp(self, data: dict) -> dict:
-        return {
-            'datum': DateParser.parse(data['datum']),
-            'orp_kod': data.get('orp_kod', None),
-            'orp_nazev': data.get('orp_nazev', None),
-            'kraj_nuts_kod': data.get('kraj_nuts_kod', None),
-            'kraj_nazev': data.get('kraj_nazev', None),
-            'pocet_davek': data.get('pocet_davek', None)
-        }
+        # grouped records are ordered by the key
+        l = merge_join(testy_merged, nakazeni_vyleceni_umrti_merged, key=('datum', 'kraj_nuts_kod'))
 
-    def create_collection_nakazeni_orp(self) -> None:
-        coll = self.get_collection('nakazeni_orp')
-
-        document = []
-
-        with open('%s/%s' % (DATA_PATH, 'obce-nakazeni.json'), 'r', encoding='utf-8') as file:
-            nakazeni = json.load(file)['data']
-
-        nakazeni = [i for i in nakazeni if i['orp_kod']]
-
-        nakazeni = sorted(nakazeni, key=lambda x: (x['datum'], x['orp_kod']))
-
-        den = nakazeni[0]['den']
-        datum = nakazeni[0]['datum']
-        nuts = nakazeni[0]['kraj_nuts_kod']
-        kraj = nakazeni[0]['kraj_nazev']
-        lau = nakazeni[0]['okres_lau_kod']
-        okres = nakazeni[0]['okres_nazev']
-        orp = nakazeni[0]['orp_kod']
-        orp_nazev = nakazeni[0]['orp_nazev']
-        nove = 0
-        aktivni = 0
-        nove65 = 0
-        nove7 = 0
-        nove14 = 0
-
-        nakazeni_merged = []
-        for data in nakazeni:
-            if data['datum'] != datum or data['orp_kod'] != orp:
-                nakazeni_merged.append({
-                    "den": den,
-                    "datum": datum,
-                    "kraj_nuts_kod": nuts,
-                    "kraj_nazev": kraj,
-                    "okres_lau_kod": lau,
-                    "okres_nazev": okres,
-                    "orp_kod": orp,
-                    "orp_nazev": orp_nazev,
-                    "nove_pripady": nove,
-                    "aktivni_pripady": aktivni,
-                    "nove_pripady_65": nove65,
-                    "nove_pripady_7_dni": nove7,
-                    "nove_pripady_14_dni": nove14
-                })
-                den = data['den']
-                datum = data['datum']
-                nuts = data['kraj_nuts_kod']
-                kraj = data['kraj_nazev']
-                lau = data['okres_lau_kod']
-                okres = data['okres_nazev']
-                orp = data['orp_kod']
-                orp_nazev = data['orp_nazev']
-                nove = data['nove_pripady']
-                aktivni = data['aktivni_pripady']
-                nove65 = data['nove_pripady_65']
-                nove7 = data['nove_pripady_7_dni']
-                nove14 = data['nove_pripady_14_dni']
-            else:
-                nove += data['nove_pripady']
-                aktivni += data['aktivni_pripady']
-                nove65 += data['nove_pripady_65']
-                nove7 += data['nove_pripady_7_dni']
-                nove14 += data['nove_pripady_14_dni']
-
-        nakazeni_merged.append({
-            "den": den,
-            "datum": datum,
-            "kraj_nuts_kod": nuts,
-            "kraj_nazev": kraj,
-            "okres_lau_kod": lau,
-            "okres_nazev": okres,
-            "orp_kod": orp,
-            "orp_nazev": orp_nazev,
-            "nove_pripady": nove,
-            "aktivni_pripady": aktivni,
-            "nove_pripady_65": nove65,
-            "nove_pripady_7_dni": nove7,
-            "nove_pripady_14_dni": nove14
-        })
-
-        for data in nakazeni_merged:
-            if type(data) is dict:
-                document.append(self.create_record_nakazeni_orp(data))
-
-        coll.insert_many(document)
-
-    def create_record_nakazeni_orp(self, data: dict) -> dict:
-        return {
-            'datum': DateParser.parse(data['datum']),
-            'kraj_nuts_kod': data.get('kraj_nuts_kod', None),
-            'kraj_nazev': data.get('kraj_nazev', None),
-            'okres_lau_kod': data.get('okres_lau_kod', None),
-            'okres_nazev': data.get('okres_nazev', None),
-            'orp_kod': data.get('orp_kod', None),
-            'orp_nazev': data.get('orp_nazev', None),
-            'nove_pripady': data.get('nove_pripady', None),
-            'aktivni_pripady': data.get('aktivni_pripady', None),
-            'nove_pripady_65': data.get('nove_pripady_65', None),
-            'nove_pripady_7_dni': data.get('nove_pripady_7_dni', None),
-            'nove_pripady_14_dni': data.get('nove_pripady_14_dni', None)
-        }
+        self.insert_records(coll, 'nakazeni_vyleceni_umrti_testy_kraj', l)
 
-    def create_collection_nakazeni_hospitalizovani_orp(self) -> None:
-        coll = self.get_collection('nakazeni-hospitalizovani-orp')
+    def create_collection_ockovani_orp(self) -> None:
+        coll = self.get_build_collection('ockovani_orp')
 
-        document = []
+        ockovani = (i for i in self.read_delta(self.read_dataset('orp-ockovani-geografie.json')) if i['orp_bydliste_kod'])
+        ockovani_merged = group_by(ockovani, {'datum': 'datum', 'orp_kod': 'orp_bydliste_kod'}, self.project_reducers('ockovani_orp', {
+            'kraj_nuts_kod': First('kraj_nuts_kod'),
+            'kraj_nazev': First('kraj_nazev'),
+            'orp_nazev': First('orp_bydliste'),
+            'pocet_davek': Sum('pocet_davek')
+        }), memory_budget=self.memory_budget)
 
-        with open('%s/%s' % (DATA_PATH, 'orp-nakazeni-hospitalizovani.json'), 'r', encoding='utf-8') as file:
-            json_data = json.load(file)['data']
+        self.insert_records(coll, 'ockovani_orp', ockovani_merged)
 
-        for data in json_data:
-            document.append(self.create_record_nakazeni_hospitalizovani_orp(data))
+    def create_collection_nakazeni_orp(self) -> None:
+        coll = self.get_build_collection('nakazeni_orp')
+
+        nakazeni = (i for i in self.read_delta(self.read_dataset('obce-nakazeni.json')) if i['orp_kod'])
+        nakazeni_merged = group_by(nakazeni, ('datum', 'orp_kod'), self.project_reducers('nakazeni_orp', {
+            'kraj_nuts_kod': First('kraj_nuts_kod'),
+            'kraj_nazev': First('kraj_nazev'),
+            'okres_lau_kod': First('okres_lau_kod'),
+            'okres_nazev': First('okres_nazev'),
+            'orp_nazev': First('orp_nazev'),
+            'nove_pripady': Sum('nove_pripady'),
+            'aktivni_pripady': Sum('aktivni_pripady'),
+            'nove_pripady_65': Sum('nove_pripady_65'),
+            'nove_pripady_7_dni': Sum('nove_pripady_7_dni'),
+            'nove_pripady_14_dni': Sum('nove_pripady_14_dni')
+        }), memory_budget=self.memory_budget)
+
+        self.insert_records(coll, 'nakazeni_orp', nakazeni_merged)
 
-        coll.insert_many(document)
+    def create_collection_nakazeni_hospitalizovani_orp(self) -> None:
+        coll = self.get_build_collection('nakazeni-hospitalizovani-orp')
 
-    def create_record_nakazeni_hospitalizovani_orp(self, data: OrderedDict) -> dict:
-        return {
-            'den': data.get('den', None),
-            'datum': DateParser.parse(data['datum']),
-            'orp_kod': data.get('orp_kod', None),
-            'orp_nazev': data.get('orp_nazev', None),
-            'incidence_7': data.get('incidence_7', None),
-            'incidence_65_7': data.get('incidence_65_7', None),
-            'incidence_75_7': data.get('incidence_75_7', None),
-            'prevalence': data.get('prevalence', None),
-            'prevalence_65': data.get('prevalence_65', None),
-            'prevalence_75': data.get('prevalence_75', None),
-            'aktualni_pocet_hospitalizovanych_osob': data.get('aktualni_pocet_hospitalizovanych_osob', None),
-            'nove_hosp_7': data.get('nove_hosp_7', None),
-            'testy_7': data.get('testy_7', None)
-        }
+        self.insert_dataset(coll, 'nakazeni-hospitalizovani-orp', 'orp-nakazeni-hospitalizovani.json')
 
     def create_collection_umrti_cr(self) -> None:
-        coll = self.get_collection('umrti_cr')
+        coll = self.get_build_collection('umrti_cr')
 
-        min_datum = DateParser.parse('2018-01-01')
-        document = []
-        with open('%s/%s' % (DATA_PATH, 'cr-zemreli.csv'), 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
+        self.insert_documents(coll, self.add_calendar_fields(self.read_umrti_cr(), 'casref_od'))
 
-            for data in reader:
-                casref_od = DateParser.parse(data['casref_od'])
-                if casref_od > min_datum:
-                  document.append(self.create_record_umrti_cr(data, casref_od))
+    def read_umrti_cr(self) -> Iterator[dict]:
+        min_datum = parse_date('2018-01-01')
+        transform = self.get_transformer('umrti_cr')
 
-        coll.insert_many(document)
-
-    def create_record_umrti_cr(self, data: OrderedDict, casref_od) -> dict:
-        return {
-            'pocet': int(data['hodnota']) if data['hodnota'] else None,
-            'vek_kod': data['vek_kod'], # CSU 7700
-            'vek_txt': data['vek_txt'],
-            'casref_od': casref_od,
-            'casref_do': DateParser.parse(data['casref_do']),
-            'priznak': data['priznak']
-        }
+        for data in read_csv_data('cr-zemreli.csv', ['casref_od', *self.get_schema('umrti_cr').sources]):
+            if parse_date(data['casref_od']) > min_datum:
+                yield transform(data)
 
     def create_collection_obyvatele_orp(self) -> None:
-        coll = self.get_collection('obyvatele_orp')
+        coll = self.get_build_collection('obyvatele_orp')
 
         orp = ORP()
         kraje = Kraje()
 
-        document = []
+        # age groups of CSU7700 codes of single years of age, 60+ is 60-99 (the 100+ code is not counted in any group)
+        cis = get_csu7700_ciselnik()
+        vekove_skupiny = {}
+        for vek, kod in cis.items():
+            if vek < 100:
+                vekove_skupiny[kod] = '0-14' if vek < 15 else ('15-59' if vek < 60 else '60+')
+
+        def read_records() -> Iterator[dict]:
+            transform = self.get_transformer('obyvatele_orp')
 
-        with open('%s/%s' % (DATA_PATH, 'orp-populace.csv'), 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for data in reader:
+            for data in read_csv_data('orp-populace.csv', ['vuzemi_kod', *self.get_schema('obyvatele_orp').sources]):
                 try:
                     orp_kod = int(data['vuzemi_kod'])
                 except:
@@ -556,91 +795,398 @@ class DBC:
                     if kraj_kod:
                         nuts_kod = kraje.get_nuts(kraj_kod)
 
-                document.append(self.create_record_obyvatele_orp(data, orp_kod, nuts_kod))
-
-        cis = get_csu7700_ciselnik()
-        document = sorted(document, key=lambda x: (x['casref_do'], x['orp_kod'], x['pohlavi_kod']))
-        l = []
-        i = {'casref_do': document[0]['casref_do'],
-            'orp_kod' : document[0]['orp_kod'],
-            'kraj_nuts_kod' : document[0]['kraj_nuts_kod'],
-            'orp_nazev' : document[0]['orp_nazev'],
-            'pohlavi_kod' : document[0]['pohlavi_kod']
-            }
-        m = {}
-        for data in document:
-            if data['casref_do'] == i['casref_do'] and data['orp_kod'] == i['orp_kod'] and data['pohlavi_kod'] == i['pohlavi_kod']:
-                m[data['vek_kod']] = data['pocet']
-            else:
-                summ = 0
-                for j in range(0, 15):
-                    if cis[j] in m:
-                        summ += m[cis[j]]
-                i['0-14'] = summ
-                summ = 0
-                for j in range(15, 60):
-                    if cis[j] in m:
-                        summ += m[cis[j]]
-                i['15-59'] = summ
-                summ = 0
-                for j in range(60, 100):
-                    if cis[j] in m:
-                        summ += m[cis[j]]
-                i['60+'] = summ
-                l.append(i)
-                i = {}
-                m = {}
-                i = {'casref_do': data['casref_do'],
-                    'orp_kod' : data['orp_kod'],
-                    'kraj_nuts_kod' : data['kraj_nuts_kod'],
-                    'orp_nazev' : data['orp_nazev'],
-                    'pohlavi_kod' : data['pohlavi_kod']
-                    }
-        summ = 0
-        for j in range(0, 15):
-            if cis[j] in m:
-                summ += m[cis[j]]
-        i['0-14'] = summ
-        summ = 0
-        for j in range(15, 60):
-            if cis[j] in m:
-                summ += m[cis[j]]
-        i['15-59'] = summ
-        summ = 0
-        for j in range(60, 100):
-            if cis[j] in m:
-                summ += m[cis[j]]
-        i['60+'] = summ
-        l.append(i)
-
-        coll.insert_many(l)
-
-    def create_record_obyvatele_orp(self, data: OrderedDict, orp_kod, nuts_kod) -> dict:
-        return {
-            'pocet': int(data['hodnota']) if data['hodnota'] else None,
-            'pohlavi_kod': int(data['pohlavi_kod']) if data['pohlavi_kod'] else '', # 1=muz, 2=zena
-            'vek_kod': data['vek_kod'], # CSU7700
-            'vek_txt': data['vek_txt'],
-            'orp_kod': orp_kod,
-            'kraj_nuts_kod': nuts_kod,
-            'orp_nazev': data['vuzemi_txt'],
-            'casref_do': DateParser.parse(data['casref_do'])
-        }
-
-    def create_all_collections(self) -> None:
-        self.delete_db()
-
-        self.create_collection_obyvatelstvo_kraj()
-        self.create_collection_covid_po_dnech_cr()
-        self.create_collection_nakazeni_vek_okres_kraj()
-        self.create_collection_nakazeni_vyleceni_umrti_testy_kraj()
-        self.create_collection_ockovani_orp()
-        self.create_collection_nakazeni_orp()
-        self.create_collection_umrti_vek_okres_kraj()
-        self.create_collection_vyleceni_vek_okres_kraj()
-        self.create_collection_nakazeni_hospitalizovani_orp()
-        self.create_collection_obyvatele_orp()
-        self.create_collection_umrti_cr()
+                data['orp_kod'] = orp_kod
+                data['kraj_nuts_kod'] = nuts_kod
+                record = transform(data)
+                skupina = vekove_skupiny.get(record['vek_kod'], None)
+                for name in ('0-14', '15-59', '60+'):
+                    record[name] = record['pocet'] if name == skupina else 0
+
+                yield record
+
+        document = group_by(read_records(), ('casref_do', 'orp_kod', 'pohlavi_kod'), {
+            'kraj_nuts_kod': First('kraj_nuts_kod'),
+            'orp_nazev': First('orp_nazev'),
+            '0-14': Sum('0-14'),
+            '15-59': Sum('15-59'),
+            '60+': Sum('60+')
+        }, memory_budget=self.memory_budget)
+
+        self.insert_documents(coll, self.add_calendar_fields(document, 'casref_do'))
+
+    def create_rollup(self, name: str, source: str, key: Tuple[str, ...], sums: List[str]) -> None:
+        """Aggregate the daily records of the source collection over PERIODS, grouped by perioda, datum_od, datum_do and key
+            Sums ignore missing values like $sum
+            Computed in a single pass on the client, so it does not need $merge of MongoDB 4.2"""
+        coll = self.get_build_collection(name)
+
+        projection = dict.fromkeys(['datum', *key, *sums], True)
+        projection['_id'] = False
+        daily = self.get_collection(source).find({}, projection)
+
+        def read_periods() -> Iterator[dict]:
+            for data in daily:
+                for field in sums:
+                    if data.get(field, None) is None:
+                        data[field] = 0
+
+                for perioda in PERIODS:
+                    datum_od, datum_do = get_period(data['datum'], perioda)
+                    yield {**data, 'perioda': perioda, 'datum_od': datum_od, 'datum_do': datum_do}
+
+        reducers = {field: Sum(field) for field in sums}
+        rollup = group_by(read_periods(), ('perioda', 'datum_od', 'datum_do', *key), reducers, memory_budget=self.memory_budget)
+
+        self.insert_documents(coll, self.add_calendar_fields(rollup, 'datum_od'))
+
+    def create_collection_covid_po_obdobich_cr(self) -> None:
+        self.create_rollup('covid_po_obdobich_cr', 'covid_po_dnech_cr', (), [
+            'prirustkovy_pocet_nakazenych',
+            'prirustkovy_pocet_vylecenych',
+            'prirustkovy_pocet_umrti',
+            'prirustkovy_pocet_provedenych_testu',
+            'prirustkovy_pocet_provedenych_ag_testu',
+            'pacient_prvni_zaznam'
+        ])
+
+    def create_collection_nakazeni_po_obdobich_orp(self) -> None:
+        self.create_rollup('nakazeni_po_obdobich_orp', 'nakazeni_orp', ('orp_kod',), ['nove_pripady', 'nove_pripady_65'])
+
+    def create_collection_ockovani_po_obdobich_orp(self) -> None:
+        self.create_rollup('ockovani_po_obdobich_orp', 'ockovani_orp', ('orp_kod',), ['pocet_davek'])
+
+    def use_timeseries(self) -> bool:
+        # time series collections can not be renamed, staging uses the bucketed documents
+        return self.check_version('5') and not self.staging
+
+    def create_buckets(self, name: str, source: str, meta: List[str], values: List[str], totals: Union[List[str], None] = None) -> None:
+        """One document per ORP and month (datum is the first day of the month) with meta fields of the first day,
+            daily values (datum and values) in dny and monthly sums of totals
+            With MongoDB 5 the daily documents are inserted to a time series collection with orp_kod as metadata instead,
+            the server stores them in buckets of up to 30 days"""
+        totals = totals if totals is not None else []
+        coll = self.get_build_collection(name)
+
+        daily = self.get_collection(source).find({}, {'_id': False})
+
+        if self.use_timeseries():
+            coll = self.db.create_collection(name, timeseries={'timeField': 'datum', 'metaField': 'orp_kod', 'granularity': 'hours'})
+            self.insert_documents(coll, daily)
+            return
+
+        def read_days() -> Iterator[dict]:
+            for data in daily:
+                data['datum_od'], data['datum_do'] = get_period(data['datum'], 'mesic')
+                data['zaznam'] = {field: data.get(field, None) for field in ['datum', *values]}
+                for field in totals:
+                    if data.get(field, None) is None:
+                        data[field] = 0
+
+                yield data
+
+        reducers = {field: First(field) for field in meta}
+        reducers.update({field: Sum(field) for field in totals})
+        reducers['dny'] = Push('zaznam')
+        buckets = group_by(read_days(), {'orp_kod': 'orp_kod', 'datum': 'datum_od', 'datum_do': 'datum_do'}, reducers, memory_budget=self.memory_budget)
+
+        def sort_days(buckets: Iterable[dict]) -> Iterator[dict]:
+            for bucket in buckets:
+                bucket['dny'].sort(key=lambda x: x['datum'])
+                yield bucket
+
+        self.insert_documents(coll, self.add_calendar_fields(sort_days(buckets)))
+
+    def create_collection_nakazeni_orp_mesice(self) -> None:
+        self.create_buckets(
+            'nakazeni_orp_mesice',
+            'nakazeni_orp',
+            ['kraj_nuts_kod', 'kraj_nazev', 'okres_lau_kod', 'okres_nazev', 'orp_nazev'],
+            ['nove_pripady', 'aktivni_pripady', 'nove_pripady_65', 'nove_pripady_7_dni', 'nove_pripady_14_dni'],
+            ['nove_pripady', 'nove_pripady_65']
+        )
+
+    def create_collection_ockovani_orp_mesice(self) -> None:
+        self.create_buckets(
+            'ockovani_orp_mesice',
+            'ockovani_orp',
+            ['orp_nazev', 'kraj_nuts_kod', 'kraj_nazev'],
+            ['pocet_davek'],
+            ['pocet_davek']
+        )
+
+    def create_collection_nakazeni_hospitalizovani_orp_mesice(self) -> None:
+        self.create_buckets(
+            'nakazeni-hospitalizovani-orp-mesice',
+            'nakazeni-hospitalizovani-orp',
+            ['orp_nazev'],
+            [
+                'den',
+                'incidence_7',
+                'incidence_65_7',
+                'incidence_75_7',
+                'prevalence',
+                'prevalence_65',
+                'prevalence_75',
+                'aktualni_pocet_hospitalizovanych_osob',
+                'nove_hosp_7',
+                'testy_7'
+            ]
+        )
+
+    @staticmethod
+    def get_collection_spec(name: str) -> dict:
+        for spec in COLLECTIONS:
+            if spec['name'] == name:
+                return spec
+
+        raise DBCException('Unknown collection %s' % name)
+
+    def create_indexes(self, name: str) -> List[str]:
+        """Build the secondary indexes of the collection, done after the bulk insert so that the documents are not indexed one by one"""
+        indexes = DBC.get_collection_spec(name).get('indexes', [])
+        if not indexes:
+            return []
+
+        coll = self.get_collection(self.get_build_name(name))
+        start = time.perf_counter()
+        created = coll.create_indexes([pymongo.IndexModel(keys) for keys in indexes])
+
+        if self.log:
+            print('%s:\tindexes %s built in %.1f s' % (name, ', '.join(created), time.perf_counter() - start), flush=True)
+
+        return created
+
+    def get_index_stats(self, name: str) -> List[dict]:
+        """Usage of the indexes of the collection ($indexStats), counters are reset when mongod restarts"""
+        return list(self.get_collection(name).aggregate([{'$indexStats': {}}]))
+
+    def get_collection_scans(self, name: str) -> Union[int, None]:
+        """Number of collection scans of the collection ($collStats queryExecStats), None when the server does not report it
+            (MongoDB before 4.4), counters are reset when mongod restarts"""
+        try:
+            stats = list(self.get_collection(name).aggregate([{'$collStats': {'queryExecStats': {}}}]))
+        except pymongo.errors.OperationFailure:
+            return None
+
+        scans = stats[0].get('queryExecStats', {}).get('collectionScans', {}).get('total') if stats else None
+        return int(scans) if scans is not None else None
+
+    def get_source_hash(self, source: str, manifest: Manifest) -> str:
+        # downloaded datasets are hashed by the downloader, others (e.g. ockovani_invalid_orp.csv) are read
+        entry = manifest.get(source)
+        if entry is not None and entry.get('sha256'):
+            return entry['sha256']
+
+        return hash_dataset(source)
+
+    def get_definition_hash(self, name: str) -> str:
+        """Hash of the code of the builder and the helpers it uses, the version, the indexes and the schema with projection
+            of the collection"""
+        spec = DBC.get_collection_spec(name)
+        schema = spec.get('schema', name)
+
+        sha256 = hashlib.sha256()
+        for source in get_code_sources(getattr(DBC, spec['builder'])):
+            sha256.update(source.encode('utf-8'))
+        sha256.update(('version:%i' % spec.get('version', 0)).encode('utf-8'))
+        sha256.update(repr(spec.get('indexes', [])).encode('utf-8'))
+        if schema in SCHEMAS:
+            sha256.update(self.get_schema(schema).fingerprint().encode('utf-8'))
+
+        return sha256.hexdigest()
+
+    def get_build_hash(self, name: str, manifest: Manifest, hashes: Union[Dict[str, str], None] = None) -> str:
+        """Hash of everything the collection is built from - content of the source datasets, code of the builder,
+            the schema with projection and the hashes of the collections it depends on (so changes propagate to them)"""
+        hashes = hashes if hashes is not None else {}
+        if name in hashes:
+            return hashes[name]
+
+        spec = DBC.get_collection_spec(name)
+
+        sha256 = hashlib.sha256()
+        sha256.update(self.get_definition_hash(name).encode('utf-8'))
+        for source in spec['sources']:
+            sha256.update(('%s:%s' % (source, self.get_source_hash(source, manifest))).encode('utf-8'))
+        for dep in spec.get('depends', []):
+            sha256.update(('%s:%s' % (dep, self.get_build_hash(dep, manifest, hashes))).encode('utf-8'))
+
+        hashes[name] = sha256.hexdigest()
+        return hashes[name]
+
+    def get_changed_collections(self, names: List[str]) -> List[str]:
+        """Collections that are missing or were built from different inputs than the current ones"""
+        manifest = Manifest()
+        hashes = {}
+
+        built = {doc['_id']: doc['hash'] for doc in self.get_collection(DBC.META_COLLECTION).find({'_id': {'$in': names}})}
+        existing = set(self.db.list_collection_names())
+
+        return [name for name in names if name not in existing or built.get(name) != self.get_build_hash(name, manifest, hashes)]
+
+    def record_build(self, name: str, build_hash: str) -> None:
+        """Store the hashes of the inputs of the collection, delta collections also get the watermark (maximal datum)"""
+        record = {'hash': build_hash, 'definice': self.get_definition_hash(name), 'vytvoreno': datetime.now()}
+
+        if DBC.get_collection_spec(name).get('delta', False):
+            last = self.get_collection(name).find_one({}, {'datum': True}, sort=[('datum', pymongo.DESCENDING)])
+            record['watermark'] = last['datum'] if last is not None else None
+
+        self.get_collection(DBC.META_COLLECTION).update_one({'_id': name}, {'$set': record}, upsert=True)
+
+    def create_collection(self, name: str) -> None:
+        # inputs are hashed before the build, a dataset replaced during the build is detected by the next update
+        build_hash = self.build_hashes[name] = self.get_build_hash(name, Manifest())
+
+        getattr(self, DBC.get_collection_spec(name)['builder'])()
+        self.create_indexes(name)
+
+        # the build is complete, the checkpoint must not outlive the staging collection it describes
+        if self.checkpoints:
+            self.get_collection(DBC.CHECKPOINT_COLLECTION).delete_one({'_id': name})
+        self.swap_collection(name)
+
+        self.record_build(name, build_hash)
+        del self.build_hashes[name]
+
+    def append_collection(self, name: str) -> bool:
+        """Incremental ingestion of a daily series, days from delta_days before the stored watermark on are deleted and
+            inserted again from the current datasets (recent days are revised), older documents are kept
+            The collection is rebuilt when it has no watermark or its definition changed, returns False then"""
+        meta = self.get_collection(DBC.META_COLLECTION).find_one({'_id': name})
+        if (
+            meta is None or meta.get('watermark') is None or not self.has_collection(name)
+            or meta.get('definice') != self.get_definition_hash(name)
+        ):
+            self.create_collection(name)
+            return False
+
+        build_hash = self.get_build_hash(name, Manifest())
+        if build_hash == meta.get('hash'):
+            return True
+
+        since = meta['watermark'] - timedelta(days=self.delta_days)
+
+        self.delta_since = since
+        try:
+            deleted = self.get_collection(name).delete_many({'datum': {'$gte': since}}).deleted_count
+            if self.log:
+                print('%s:\t%i documents from %s deleted' % (name, deleted, since.date().isoformat()), flush=True)
+
+            getattr(self, DBC.get_collection_spec(name)['builder'])()
+        finally:
+            self.delta_since = None
+
+        self.record_build(name, build_hash)
+        return True
+
+    def append_collections(self, workers: int = 1) -> List[str]:
+        """Delta ingestion of the daily series (delta in COLLECTIONS), other collections are updated like in update_collections,
+            so collections derived from the daily series are rebuilt
+            Returns names of the rebuilt collections"""
+        for spec in COLLECTIONS:
+            if spec.get('delta', False) and self.use_collection(spec):
+                self.append_collection(spec['name'])
+
+        return self.update_collections(workers)
+
+    def create_collections(self, names: List[str], workers: int = 1) -> None:
+        """Create the collections in the order of COLLECTIONS
+            With workers > 1 independent collections are created in parallel in a process pool,
+            a collection is started once all collections it depends on are created"""
+        specs = [spec for spec in COLLECTIONS if spec['name'] in names]
+
+        if workers <= 1:
+            for spec in specs:
+                self.create_collection(spec['name'])
+            return
+
+        settings = self.get_settings()
+        pending = list(specs)
+        created = set()
+        running = {}
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                for spec in list(pending):
+                    # dependencies outside of names are expected to exist already
+                    if all(dep in created or dep not in names for dep in spec.get('depends', [])):
+                        running[executor.submit(build_collection, settings, spec['name'])] = spec['name']
+                        pending.remove(spec)
+
+                if not running:
+                    raise DBCException('Circular dependency between collections %s' % ', '.join(spec['name'] for spec in pending))
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+                    created.add(running.pop(future))
+
+    def use_collection(self, spec: dict) -> bool:
+        layout = spec.get('layout', None)
+        if layout == 'raw':
+            return self.histograms != 'replace'
+        if layout == 'histogram':
+            return self.histograms != 'off'
+        if spec.get('buckets', False):
+            return self.buckets
+
+        return True
+
+    def has_collection(self, name: str) -> bool:
+        return name in self.db.list_collection_names()
+
+    def drop_unused_collections(self) -> List[str]:
+        """Drop collections that are not created with the current settings (see use_collection), e.g. histograms left
+            by an earlier run with --histograms add or monthly buckets left by a run with --buckets,
+            queries choose the layout and the buckets by the existing collections
+            Returns names of the dropped collections"""
+        existing = set(self.db.list_collection_names())
+        dropped = []
+
+        for spec in COLLECTIONS:
+            if self.use_collection(spec):
+                continue
+
+            name = spec['name']
+            for coll_name in (name, DBC.STAGING_PREFIX + name):
+                if coll_name in existing:
+                    self.get_collection(coll_name, drop=True)
+                    dropped.append(coll_name)
+
+            self.get_collection(DBC.META_COLLECTION).delete_one({'_id': name})
+            self.get_collection(DBC.CHECKPOINT_COLLECTION).delete_one({'_id': name})
+
+        if self.log and dropped:
+            print('Dropped unused collections: %s' % ', '.join(dropped), flush=True)
+
+        return dropped
+
+    def create_all_collections(self, workers: int = 1) -> None:
+        """Rebuild all collections, with staging the old collections stay readable until their replacement is ready
+            With checkpoints a rerun after a failure keeps the collections that were completed and resumes the interrupted ones"""
+        if self.checkpoints:
+            self.update_collections(workers)
+            return
+
+        if not self.staging:
+            self.delete_db()
+
+        self.create_collections([spec['name'] for spec in COLLECTIONS if self.use_collection(spec)], workers)
+        # dropped once their replacements are built, so that queries keep reading them during the rebuild
+        self.drop_unused_collections()
+
+    def update_collections(self, workers: int = 1) -> List[str]:
+        """Rebuild only the collections whose inputs changed since they were built (see get_build_hash), others are kept
+            Returns names of the rebuilt collections"""
+        names = self.get_changed_collections([spec['name'] for spec in COLLECTIONS if self.use_collection(spec)])
+
+        if self.log:
+            print('Collections to rebuild: %s' % (', '.join(names) if names else 'none'), flush=True)
+
+        self.create_collections(names, workers)
+        self.drop_unused_collections()
+        return names
 
 if __name__ == '__main__':
     dbc = DBC()
@@ -8,24 +8,49 @@
 
 import requests
 import os
-import sys
+import re
+import json
+import hashlib
+import time
+import threading
 
-from typing import List
+from typing import List, Dict, Union, Tuple
+from urllib.parse import urlparse
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+from .dataset import find_dataset, stored_name, stored_variants, compress_file, check_compression
 
 DATA_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
 
+DEFAULT_WORKERS = 1
+DEFAULT_PER_HOST = 4
+
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+DEFAULT_TIMEOUT: Tuple[float, float] = (10.0, 60.0) # connect, read
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+CHUNK_SIZE = 1024 * 1024
+PARTIAL_SUFFIX = '.part'
+# validator (ETag or Last-Modified) of the response a partial file was written from
+VALIDATOR_SUFFIX = '.validator'
+MANIFEST_NAME = 'manifest.json'
+
 DATA: List[dict] = [
     # KRAJ, OKRES, ORP, OBEC
     # absolutne a prirustkove: nakazeni; nakazeni 65+, nakazeni za tyden a 14 dni
-    {'name': 'obce-nakazeni.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/obce.json', 'large': True},
+    {'name': 'obce-nakazeni.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/obce.json', 'large': True, 'compress': True},
 
     # KRAJ, OKRES
     # nakaza jednotlivych osob - vek, datum
-    {'name': 'kraj-okres-nakazeni.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/osoby.json'},
+    {'name': 'kraj-okres-nakazeni.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/osoby.json', 'compress': True},
     # vyleceni jednotlivych osob - vek, datum
-    {'name': 'kraj-okres-vyleceni.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/vyleceni.json'},
+    {'name': 'kraj-okres-vyleceni.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/vyleceni.json', 'compress': True},
     # umrti jednotlivych osob - vek, datum
-    {'name': 'kraj-okres-umrti.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/umrti.json'},
+    {'name': 'kraj-okres-umrti.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/umrti.json', 'compress': True},
     # kumulativne: nakaza, vyleceni, umrti - datum
     {'name': 'kraj-okres-nakazeni-vyleceni-umrti.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/kraj-okres-nakazeni-vyleceni-umrti.json'},
     # kumulativne a prirustkove: testy (dohromady, zaznamy pro kraj i okres)
@@ -43,7 +68,7 @@ DATA: List[dict] = [
     # absolutne: nakazeni a hospitalizovani (vsichni, 65+, 75+) - den; nakazeni, hospitalizovani, testy - tyden
     {'name': 'orp-nakazeni-hospitalizovani.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/orp.json'},
     # absolutne: ockovani podle bydliste (ORP) a typu vakciny - den
-    {'name': 'orp-ockovani-geografie.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/ockovani-geografie.json'},
+    {'name': 'orp-ockovani-geografie.json', 'url': 'https://onemocneni-aktualne.mzcr.cz/api/v2/covid-19/ockovani-geografie.json', 'compress': True},
 
     # KRAJ
     # absolutne: ockovani podle veku a typu vakciny - den
@@ -63,35 +88,332 @@ DATA: List[dict] = [
     {'name': 'orp-populace.csv', 'url': 'https://www.czso.cz/documents/62353418/143520482/130181-21data043021.csv/9dc72375-de2c-4aea-b18d-85d18f3639d8?version=1.1'}
 ]
 
+class DownloadError(Exception):
+    """Transient errors (e.g. a body shorter than announced) are retried regardless of the status"""
+    def __init__(self, message: str = '', url: Union[str, None] = None, status: Union[int, None] = None, retry_after: Union[float, None] = None, transient: bool = False):
+        super().__init__(message)
+        self.url = url
+        self.status = status
+        self.retry_after = retry_after
+        self.transient = transient
+
 def ensure_folder(path: str) -> None:
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
-def download(url: str, name: str, large: bool = False, rewrite: bool = False, log: bool = True, skipLarge: bool = False) -> None:
+def create_session(pool_size: int = DEFAULT_PER_HOST) -> requests.Session:
+    """Session keeping pooled keep-alive connections to the data hosts
+        The session does not retry, failed downloads are retried by download()"""
+    adapter = HTTPAdapter(pool_connections=DEFAULT_PER_HOST, pool_maxsize=max(pool_size, 1), max_retries=0)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+class Manifest:
+    """Record of the downloaded datasets (ETag, Last-Modified, size and content hash) stored in DATA_PATH"""
+
+    def __init__(self, path: Union[str, None] = None) -> None:
+        self.path = path if path is not None else os.path.join(DATA_PATH, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.entries: Dict[str, dict] = Manifest.load(self.path)
+
+    @staticmethod
+    def load(path: str) -> Dict[str, dict]:
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self) -> None:
+        tmp_path = self.path + PARTIAL_SUFFIX
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.entries, file, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, name: str) -> Union[dict, None]:
+        with self.lock:
+            return self.entries.get(name, None)
+
+    def update(self, name: str, entry: dict) -> None:
+        with self.lock:
+            self.entries[name] = entry
+            self.save()
+
+    def conditional_headers(self, name: str, url: str, fname: str) -> dict:
+        """Validators for a conditional request, empty when the stored file fname does not match the manifest"""
+        entry = self.get(name)
+        if entry is None or entry.get('url') != url or entry.get('file', name) != fname:
+            return {}
+
+        path = os.path.join(DATA_PATH, fname)
+        if not os.path.isfile(path) or os.path.getsize(path) != entry.get('file_size', entry.get('size')):
+            return {}
+
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+def range_validator(headers: dict) -> Union[str, None]:
+    """Validator of the response for If-Range, weak ETags can not be used for ranges"""
+    etag = headers.get('ETag', None)
+    if etag and not etag.startswith('W/'):
+        return etag
+
+    return headers.get('Last-Modified', None)
+
+def content_range_start(value: Union[str, None]) -> Union[int, None]:
+    """First byte of a Content-Range header (bytes start-end/size)"""
+    match = re.match(r'\s*bytes\s+(\d+)-\d+/(\d+|\*)', value or '')
+    return int(match.group(1)) if match is not None else None
+
+def content_range_size(value: Union[str, None]) -> Union[int, None]:
+    """Size of the complete file from a Content-Range header, None when unknown (*)"""
+    match = re.match(r'\s*bytes\s+\d+-\d+/(\d+)', value or '')
+    return int(match.group(1)) if match is not None else None
+
+def check_complete(data: requests.Response, url: str, path: str) -> None:
+    """Raise a transient DownloadError when less than the announced body was received, the partial file is kept
+        and resumed by the next attempt (urllib3 1.x does not report a connection closed before Content-Length)"""
+    length = data.headers.get('Content-Length', '')
+    # bytes read from the connection, before content decoding
+    received = data.raw.tell()
+    if length.isdigit() and received != int(length):
+        raise DownloadError('Failed to download %s (received %i of %s bytes)' % (url, received, length), url, transient=True)
+
+    size = content_range_size(data.headers.get('Content-Range', None)) if data.status_code == 206 else None
+    if size is not None and os.path.getsize(path) != size:
+        raise DownloadError('Failed to download %s (%i of %i bytes written)' % (url, os.path.getsize(path), size), url, transient=True)
+
+def read_validator(path: str, url: str) -> Union[str, None]:
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            stored = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    return stored.get('validator', None) if stored.get('url') == url else None
+
+def write_validator(path: str, url: str, validator: Union[str, None]) -> None:
+    if validator is None:
+        remove_file(path)
+        return
+
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'url': url, 'validator': validator}, file)
+
+def parse_retry_after(value: Union[str, None]) -> Union[float, None]:
+    """Delay in seconds from a Retry-After header (seconds or HTTP date)"""
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+def remove_file(path: str) -> None:
+    if os.path.isfile(path):
+        os.remove(path)
+
+def stream_to_file(session: requests.Session, url: str, path: str, headers: Union[dict, None] = None, timeout: Tuple[float, float] = DEFAULT_TIMEOUT) -> Union[dict, None]:
+    """Stream the response body to a partial file in chunks and rename it to path when complete
+        An existing partial file from an interrupted transfer is resumed with a Range request conditional on the validator
+        of the response it was written from (If-Range), a partial file without a validator is downloaded again
+        Returns the manifest entry of the file or None when the server replied 304 Not Modified"""
+    tmp_path = path + PARTIAL_SUFFIX
+    validator_path = tmp_path + VALIDATOR_SUFFIX
+    offset = os.path.getsize(tmp_path) if os.path.isfile(tmp_path) else 0
+
+    validator = read_validator(validator_path, url) if offset else None
+    if validator is None:
+        # the partial file can not be matched to a version of the dataset
+        offset = 0
+
+    headers = dict(headers) if headers else {}
+    if offset:
+        # offsets of the partial file are in decoded bytes, the range has to be requested without content encoding
+        # validators belong to the complete file, they do not apply to the partial one
+        headers = {'Range': 'bytes=%i-' % offset, 'If-Range': validator, 'Accept-Encoding': 'identity'}
+
+    with session.get(url, headers=headers, allow_redirects=True, stream=True, timeout=timeout) as data:
+        if data.status_code == 304:
+            return None
+
+        if data.status_code == 416 and offset:
+            # partial file is not valid for the current version of the dataset
+            remove_file(tmp_path)
+            remove_file(validator_path)
+            return stream_to_file(session, url, path, timeout=timeout)
+
+        if data.status_code not in (200, 206):
+            raise DownloadError(
+                'Failed to download %s (HTTP %i %s)' % (url, data.status_code, data.reason),
+                url, data.status_code, parse_retry_after(data.headers.get('Retry-After', None))
+            )
+
+        if data.status_code == 206 and content_range_start(data.headers.get('Content-Range', None)) != offset:
+            if not offset:
+                raise DownloadError('Failed to download %s (partial content without a range request)' % url, url, data.status_code)
+
+            # range does not continue the partial file
+            remove_file(tmp_path)
+            remove_file(validator_path)
+            return stream_to_file(session, url, path, timeout=timeout)
+
+        sha256 = hashlib.sha256()
+
+        # 200 means the server ignored the range or the dataset changed since the partial file was written (If-Range),
+        # start from the beginning
+        if data.status_code == 206:
+            mode = 'ab'
+            with open(tmp_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+        else:
+            mode = 'wb'
+            write_validator(validator_path, url, range_validator(data.headers))
+
+        with open(tmp_path, mode) as file:
+            for chunk in data.iter_content(chunk_size=CHUNK_SIZE):
+                sha256.update(chunk)
+                file.write(chunk)
+
+        check_complete(data, url, tmp_path)
+
+        entry = {
+            'url': url,
+            'etag': data.headers.get('ETag', None),
+            'last_modified': data.headers.get('Last-Modified', None),
+            'size': os.path.getsize(tmp_path),
+            'sha256': sha256.hexdigest()
+        }
+
+    os.replace(tmp_path, path)
+    remove_file(validator_path)
+
+    return entry
+
+def store_dataset(name: str, compression: Union[str, None] = None) -> str:
+    """Compress the downloaded file if requested and remove other stored variants of the dataset
+        Returns the name of the stored file"""
+    fname = stored_name(name, compression)
+    if compression is not None:
+        compress_file('%s/%s' % (DATA_PATH, name), '%s/%s' % (DATA_PATH, fname), compression)
+
+    for variant in stored_variants(name):
+        path = '%s/%s' % (DATA_PATH, variant)
+        if variant != fname and os.path.isfile(path):
+            os.remove(path)
+
+    return fname
+
+def download(url: str, name: str, large: bool = False, rewrite: bool = False, log: bool = True, skipLarge: bool = False, manifest: Union[Manifest, None] = None, session: Union[requests.Session, None] = None, retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF, compression: Union[str, None] = None) -> float:
     path = '%s/%s' % (DATA_PATH, name)
 
-    if not rewrite and os.path.isfile(path) or large and skipLarge:
+    if not rewrite and find_dataset(name, DATA_PATH) is not None or large and skipLarge:
         if log:
             print('Skipped:\t%s' % name)
-        return
+        return 0.0
+
+    if session is None:
+        session = create_session()
+
+    start = time.perf_counter()
+
+    headers = manifest.conditional_headers(name, url, stored_name(name, compression)) if manifest is not None else {}
+
+    # the only retry layer - connection errors, timeouts, short bodies and HTTP statuses in RETRY_STATUS are retried with exponential
+    # backoff (or after Retry-After), a transfer broken off mid-body is resumed from the partial file
+    attempt = 0
+    while True:
+        try:
+            entry = stream_to_file(session, url, path, headers)
+            break
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exc:
+            error, status, delay = exc, None, None
+        except DownloadError as exc:
+            if exc.status not in RETRY_STATUS and not exc.transient:
+                raise
+            error, status, delay = exc, exc.status, exc.retry_after
+        except requests.RequestException as exc:
+            raise DownloadError('Failed to download %s (%s)' % (url, exc), url) from exc
+
+        attempt += 1
+        if attempt > retries:
+            message = str(error) if isinstance(error, DownloadError) else 'Failed to download %s (%s)' % (url, error)
+            raise DownloadError('%s, gave up after %i retries' % (message, retries), url, status) from error
+        time.sleep(delay if delay is not None else backoff * (2 ** (attempt - 1)))
+
+    if entry is not None:
+        entry['file'] = store_dataset(name, compression)
+        entry['file_size'] = os.path.getsize('%s/%s' % (DATA_PATH, entry['file']))
 
-    data = requests.get(url, allow_redirects=True)
+    elapsed = time.perf_counter() - start
 
-    if data.status_code != 200:
-        print(data.headers, file=sys.stderr)
-        sys.exit()
+    if entry is None:
+        if log:
+            print('Not modified:\t%s' % name)
+        return elapsed
 
-    file = open(path, 'wb')
-    file.write(data.content)
-    file.close()
+    if manifest is not None:
+        manifest.update(name, entry)
 
     if log:
-        print('Downloaded:\t%s' % name)
+        print('Downloaded:\t%s (%.1f s)' % (name, elapsed))
+
+    return elapsed
 
-def download_data(rewrite: bool = False, log: bool = True, skipLarge = False):
+def download_data(rewrite: bool = False, log: bool = True, skipLarge = False, workers: int = DEFAULT_WORKERS, per_host: int = DEFAULT_PER_HOST, force: bool = False, session: Union[requests.Session, None] = None, retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF, compression: Union[str, None] = None) -> float:
+    """Download all datasets, returns the summed duration of the individual downloads
+        Files recorded in the manifest are requested conditionally and kept when not modified, unless force is set
+        With workers > 1 the downloads run concurrently, at most per_host at once for a single host
+        Datasets marked with compress are stored compressed when compression (gzip, zstd) is given
+        Raises DownloadError for the first dataset that could not be downloaded after all retries"""
+    check_compression(compression)
     ensure_folder(DATA_PATH + '/')
 
+    manifest = Manifest()
+    if force:
+        manifest.entries = {}
+
+    if session is None:
+        session = create_session(max(workers, per_host))
+
+    if workers <= 1:
+        return sum(download(data['url'], data['name'], data.get('large', False), rewrite, log, skipLarge, manifest, session, retries, backoff, compression if data.get('compress', False) else None) for data in DATA)
+
+    hosts: Dict[str, threading.Semaphore] = {}
     for data in DATA:
-        download(data['url'], data['name'], data.get('large', False), rewrite, log, skipLarge)
+        host = urlparse(data['url']).netloc
+        if host not in hosts:
+            hosts[host] = threading.Semaphore(max(per_host, 1))
+
+    def download_limited(data: dict) -> float:
+        with hosts[urlparse(data['url']).netloc]:
+            return download(data['url'], data['name'], data.get('large', False), rewrite, log, skipLarge, manifest, session, retries, backoff, compression if data.get('compress', False) else None)
+
+    # large files first so that they do not end up as the last running downloads
+    queue = sorted(DATA, key=lambda x: not x.get('large', False))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download_limited, data) for data in queue]
+        return sum(future.result() for future in futures)
 
 if __name__ == '__main__':
     download_data()
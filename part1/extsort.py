@@ -0,0 +1,117 @@
+##
+# @file extsort.py
+# Subject: UPA - Data Storage and Preparation
+# @date: 10/2026
+# External merge sort with sorted runs spilled to temporary files
+
+import heapq
+import os
+import pickle
+import sys
+import tempfile
+
+from typing import Any, Callable, Iterable, Iterator, List, Tuple, Union
+
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+SAMPLE_INTERVAL = 1000
+
+def estimate_size(obj: Any) -> int:
+    """Approximate memory used by a record, the object and its direct items"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sys.getsizeof(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(sys.getsizeof(v) for v in obj)
+
+    return size
+
+class SizeEstimator:
+    """Running estimate of the memory used by buffered items, sizes are sampled"""
+
+    def __init__(self) -> None:
+        self.sampled = 0
+        self.sampled_bytes = 0
+        self.count = 0
+
+    def add(self, item: Any) -> None:
+        if self.count % SAMPLE_INTERVAL == 0:
+            self.sampled += 1
+            self.sampled_bytes += estimate_size(item)
+        self.count += 1
+
+    def get_bytes(self, count: int) -> int:
+        return int(count * self.sampled_bytes / self.sampled) if self.sampled else 0
+
+class SortedRuns:
+    """Sorted runs stored in temporary files, merged lazily"""
+
+    def __init__(self, tmpdir: Union[str, None] = None) -> None:
+        self.tmpdir = tmpdir
+        self.paths: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def spill(self, items: Iterable) -> None:
+        fd, path = tempfile.mkstemp(prefix='upa-run-', suffix='.pickle', dir=self.tmpdir)
+        self.paths.append(path)
+        with os.fdopen(fd, 'wb') as file:
+            pickler = pickle.Pickler(file, protocol=pickle.HIGHEST_PROTOCOL)
+            for item in items:
+                pickler.dump(item)
+                # memo would keep every dumped item alive
+                pickler.clear_memo()
+
+    @staticmethod
+    def read(path: str) -> Iterator:
+        with open(path, 'rb') as file:
+            unpickler = pickle.Unpickler(file)
+            while True:
+                try:
+                    yield unpickler.load()
+                except EOFError:
+                    return
+
+    def merge(self, key: Union[Callable, None] = None, extra: Tuple[Iterable, ...] = ()) -> Iterator:
+        """Merge the runs and sorted extra iterables (after the runs), ties keep the order of the runs"""
+        try:
+            yield from heapq.merge(*[SortedRuns.read(path) for path in self.paths], *extra, key=key)
+        finally:
+            self.remove()
+
+    def remove(self) -> None:
+        for path in self.paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.paths = []
+
+def external_sorted(
+    iterable: Iterable,
+    key: Union[Callable, None] = None,
+    memory_budget: Union[int, None] = DEFAULT_MEMORY_BUDGET,
+    tmpdir: Union[str, None] = None
+) -> Iterator:
+    """Stable sort of items that do not have to fit into memory
+        Items are buffered up to memory_budget bytes (estimated), full buffers are sorted and spilled to temporary files
+        When the input fits into the budget (or memory_budget is None) it is sorted in memory"""
+    runs = SortedRuns(tmpdir)
+    estimator = SizeEstimator()
+    buffer = []
+
+    for item in iterable:
+        estimator.add(item)
+        buffer.append(item)
+        if memory_budget is not None and estimator.get_bytes(len(buffer)) > memory_budget:
+            buffer.sort(key=key)
+            runs.spill(buffer)
+            buffer = []
+
+    buffer.sort(key=key)
+    if not runs:
+        yield from buffer
+        return
+
+    # last run stays in memory, it is merged after the spilled ones to keep the sort stable
+    yield from runs.merge(key, (buffer,))
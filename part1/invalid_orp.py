@@ -5,7 +5,6 @@
 # @date: 12/2021
 # Detect unknown ORP codes in MZČR datasets
 
-import json
 import sys
 import csv
 import os
@@ -13,6 +12,7 @@ import os
 from typing import Union
 
 from .download import DATA_PATH
+from .dataset import read_json_data
 from .ciselniky import ORP
 
 class InvalidORPCodeDetector():
@@ -45,11 +45,8 @@ class InvalidORPCodeDetector():
             print('Unknown file name for invalid ORP code detection %s' % fname, file=sys.stderr)
             sys.exit(3)
 
-        with open(os.path.join(DATA_PATH, fname), 'r', encoding='utf-8') as file:
-            doc = json.load(file)['data']
-
         missing_orps = set()
-        for data in doc:
+        for data in read_json_data(fname):
             if data[code_key] not in self.orp_helper.orp.keys():
                 missing_orps.add((data[name_key], data[code_key]))
 
@@ -0,0 +1,265 @@
+##
+# @file jsonchunks.py
+# Subject: UPA - Data Storage and Preparation
+# @date: 10/2026
+# Parallel decoding of the data array of large MZČR datasets split at record boundaries
+
+import io
+import json
+import os
+import re
+import timeit
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, IO, Iterator, List, Tuple, Union
+
+from .dataset import find_dataset, open_binary, open_dataset, SUFFIXES
+from .jsonstream import JSONArrayReader, JSONStreamError, iter_json_data
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND_JSON = 'json'
+BACKEND_ORJSON = 'orjson'
+BACKENDS = (BACKEND_JSON, BACKEND_ORJSON)
+
+DEFAULT_CHUNK_BYTES = 16 * 1024 * 1024
+# start of the file searched for the data array, end of the file searched for its end
+HEAD_BYTES = 1024 * 1024
+TAIL_BYTES = 4096
+
+# records of MZCR datasets are flat objects, a boundary is the end of one record and the start of the next one
+BOUNDARY = re.compile(rb'}\s*,\s*{')
+WHITESPACE = b' \t\n\r'
+
+def default_backend() -> str:
+    return BACKEND_ORJSON if orjson is not None else BACKEND_JSON
+
+def check_backend(backend: Union[str, None]) -> None:
+    if backend is not None and backend not in BACKENDS:
+        raise ValueError('Unknown JSON backend %s (expected one of: %s)' % (backend, ', '.join(BACKENDS)))
+    if backend == BACKEND_ORJSON and orjson is None:
+        raise ValueError('JSON backend %s requires the orjson module' % backend)
+
+def decode_records(data: bytes, backend: str = BACKEND_JSON) -> List[dict]:
+    """Records of a byte range of the data array (records separated by commas, without the brackets)
+        A range cut inside a string value that contains a record boundary does not decode, DBC.read_chunks reads the rest sequentially then"""
+    data = b'[' + data + b']'
+    try:
+        return orjson.loads(data) if backend == BACKEND_ORJSON else json.loads(data)
+    except ValueError as exc:
+        raise JSONStreamError('Failed to decode records split at record boundaries (%s), use read_json_data' % exc) from exc
+
+def find_array(head: bytes, key: str = 'data') -> int:
+    """Byte offset of the first value of the array stored under key, it has to start in head"""
+    # a character cut at the end of head is dropped, offsets before it are not affected
+    text = head.decode('utf-8', errors='ignore')
+    reader = JSONArrayReader(io.StringIO(text), read_size=len(text) + 1)
+    reader.find_key(key)
+    reader.expect('[')
+
+    return len(text[:reader.pos].encode('utf-8'))
+
+def find_array_end(tail: bytes, size: int) -> int:
+    """Byte offset of the closing bracket of the data array, which has to be the last value of the document"""
+    pos = tail.rfind(b']')
+    if pos < 0 or tail[pos + 1:].strip() != b'}':
+        raise JSONStreamError('Data array is not the last value of the JSON document')
+
+    return size - len(tail) + pos
+
+def find_boundary(file: IO[bytes], pos: int, end: int) -> Union[Tuple[int, int], None]:
+    """First record boundary after pos as (end of the record, start of the next one), None if there is none before end"""
+    while pos < end:
+        file.seek(pos)
+        window = file.read(min(HEAD_BYTES, end - pos))
+        match = BOUNDARY.search(window)
+        if match is not None:
+            return pos + match.start() + 1, pos + match.end() - 1
+
+        # the boundary may be cut at the end of the window
+        pos += max(len(window) - 16, 1)
+
+    return None
+
+def split_ranges(path: str, key: str = 'data', chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> List[Tuple[int, int]]:
+    """Byte ranges of records of the data array of an uncompressed file, each around chunk_bytes long"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        start = find_array(file.read(HEAD_BYTES), key)
+        file.seek(max(size - TAIL_BYTES, 0))
+        end = find_array_end(file.read(), size)
+
+        ranges = []
+        while start < end:
+            boundary = find_boundary(file, start + chunk_bytes, end) if start + chunk_bytes < end else None
+            if boundary is None:
+                ranges.append((start, end))
+                break
+
+            ranges.append((start, boundary[0]))
+            start = boundary[1]
+
+    # empty array
+    return [(start, end) for start, end in ranges if start < end]
+
+def find_last_boundary(buffer: bytes, start: int = 0) -> Union[Tuple[int, int], None]:
+    """Last record boundary in buffer after start as (end of the record, start of the next one)"""
+    pos = len(buffer)
+    while True:
+        pos = buffer.rfind(b'{', start, pos)
+        if pos < 0:
+            return None
+
+        i = pos - 1
+        while i >= start and buffer[i] in WHITESPACE:
+            i -= 1
+        if i >= start and buffer[i] == ord(','):
+            i -= 1
+            while i >= start and buffer[i] in WHITESPACE:
+                i -= 1
+            if i >= start and buffer[i] == ord('}'):
+                return i + 1, pos
+
+def read_full(file: IO[bytes], size: int) -> bytes:
+    # decompressing readers may return less than requested
+    chunks = []
+    while size > 0:
+        chunk = file.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b''.join(chunks)
+
+def read_blocks(file: IO[bytes], key: str = 'data', chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> Iterator[bytes]:
+    """Blocks of records of the data array read sequentially from a (decompressed) stream, cut at record boundaries"""
+    buffer = read_full(file, max(chunk_bytes, HEAD_BYTES))
+    buffer = buffer[find_array(buffer[:HEAD_BYTES], key):]
+
+    while True:
+        data = read_full(file, chunk_bytes)
+        if not data:
+            break
+
+        buffer += data
+        boundary = find_last_boundary(buffer)
+        if boundary is None:
+            continue
+
+        yield buffer[:boundary[0]]
+        buffer = buffer[boundary[1]:]
+
+    last = find_array_end(buffer[-TAIL_BYTES:], len(buffer))
+    if buffer[:last].strip():
+        yield buffer[:last]
+
+def decode_range(path: str, start: int, end: int, backend: str, func: Union[Callable, None] = None, args: tuple = ()) -> Any:
+    """Decode records of a byte range of the file, used by the worker processes
+        With func the result of func(records, *args) is returned instead of the records"""
+    with open(path, 'rb') as file:
+        file.seek(start)
+        records = decode_records(file.read(end - start), backend)
+
+    return func(records, *args) if func is not None else records
+
+def decode_block(data: bytes, backend: str, func: Union[Callable, None] = None, args: tuple = ()) -> Any:
+    records = decode_records(data, backend)
+    return func(records, *args) if func is not None else records
+
+def map_json_data(
+    name: str,
+    func: Union[Callable, None] = None,
+    args: tuple = (),
+    workers: Union[int, None] = None,
+    backend: Union[str, None] = None,
+    key: str = 'data',
+    chunk_bytes: int = DEFAULT_CHUNK_BYTES
+) -> Iterator[Any]:
+    """Decode the data array of a downloaded JSON dataset in chunks in a process pool, yields the chunks in the order of the file
+        A chunk is a list of records, or the result of func(records, *args) computed by the worker (func has to be picklable),
+        so records can be transformed before they are sent back
+        Uncompressed files are split to byte ranges read by the workers, compressed files are decompressed by this process
+        and the blocks are sent to the workers
+        Usage:
+            for records in map_json_data('obce-nakazeni.json', workers=4):"""
+    check_backend(backend)
+    backend = backend if backend is not None else default_backend()
+
+    fpath = find_dataset(name)
+    if fpath is None:
+        raise FileNotFoundError('Dataset %s not found' % name)
+
+    compressed = any(fpath.endswith(suffix) for suffix in SUFFIXES.values())
+
+    workers = workers if workers is not None else (os.cpu_count() or 1)
+    # chunks in flight are limited, a decoded chunk takes several times its size in memory
+    limit = 2 * workers
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        if compressed:
+            file = open_binary(fpath)
+            tasks = ((decode_block, block, backend, func, args) for block in read_blocks(file, key, chunk_bytes))
+        else:
+            file = None
+            tasks = ((decode_range, fpath, start, end, backend, func, args) for start, end in split_ranges(fpath, key, chunk_bytes))
+
+        try:
+            for task in tasks:
+                pending.append(executor.submit(*task))
+                if len(pending) >= limit:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            if file is not None:
+                file.close()
+
+def read_json_chunks(
+    name: str,
+    workers: Union[int, None] = None,
+    backend: Union[str, None] = None,
+    key: str = 'data',
+    chunk_bytes: int = DEFAULT_CHUNK_BYTES
+) -> Iterator[dict]:
+    """Records of a downloaded JSON dataset decoded in parallel, in the order of the file (same as read_json_data)"""
+    for records in map_json_data(name, workers=workers, backend=backend, key=key, chunk_bytes=chunk_bytes):
+        yield from records
+
+def benchmark(name: str = 'obce-nakazeni.json', workers: Union[int, None] = None, repeat: int = 3) -> None:
+    """Compare decoding of the dataset with json.load, the incremental parser and the parallel decoding"""
+
+    def load_json():
+        with open_dataset(name) as file:
+            return len(json.load(file)['data'])
+
+    def load_stream():
+        with open_dataset(name) as file:
+            return sum(1 for _ in iter_json_data(file))
+
+    def load_chunks(backend: str) -> Callable[[], int]:
+        return lambda: sum(1 for _ in read_json_chunks(name, workers, backend))
+
+    methods = [('json.load', load_json), ('iter_json_data', load_stream), ('chunks json', load_chunks(BACKEND_JSON))]
+    if orjson is not None:
+        methods.append(('chunks orjson', load_chunks(BACKEND_ORJSON)))
+
+    print('%s: %i records, %s' % (name, load_json(), find_dataset(name)))
+
+    base_time = None
+    for method, func in methods:
+        elapsed = min(timeit.repeat(func, number=1, repeat=repeat))
+        base_time = base_time if base_time is not None else elapsed
+        print('%s:\t%.3f s (%.1fx)' % (method, elapsed, base_time / elapsed if elapsed else 0.0))
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,115 @@
+##
+# @file jsonstream.py
+# Subject: UPA - Data Storage and Preparation
+# @date: 10/2026
+# Incremental parsing of records from the data array of MZČR datasets
+
+import json
+
+from typing import IO, Iterator, Iterable, List
+
+READ_SIZE = 1024 * 1024
+WHITESPACE = ' \t\n\r'
+
+class JSONStreamError(Exception):
+    def __init__(self, message: str = ''):
+        super().__init__(message)
+
+class JSONArrayReader:
+    """Reads values of an array stored under a top-level key of a JSON object one at a time
+        Only the currently parsed value and a read buffer are kept in memory"""
+
+    def __init__(self, file: IO[str], read_size: int = READ_SIZE) -> None:
+        self.file = file
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+
+        chunk = self.file.read(self.read_size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise JSONStreamError('Unexpected end of JSON document')
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise JSONStreamError('Expected "%s" at position %i, found "%s"' % (char, self.pos, self.buffer[self.pos]))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+
+            # a number may continue in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+    def find_key(self, key: str) -> None:
+        self.expect('{')
+        while True:
+            name = self.value()
+            self.expect(':')
+            if name == key:
+                return
+
+            self.value()
+            if self.peek() == '}':
+                raise JSONStreamError('Key "%s" not found in JSON document' % key)
+            self.expect(',')
+
+    def items(self, key: str = 'data') -> Iterator:
+        self.find_key(key)
+        self.expect('[')
+
+        if self.peek() == ']':
+            return
+
+        while True:
+            yield self.value()
+
+            if self.peek() == ']':
+                return
+            self.expect(',')
+
+def iter_json_data(file: IO[str], key: str = 'data') -> Iterator[dict]:
+    """Usage:
+        for record in iter_json_data(file):"""
+    return JSONArrayReader(file).items(key)
+
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
@@ -3,91 +3,98 @@
 # @author Oliver Kuník xkunik00@stud.fit.vutbr.cz
 # Subject: UPA - Data Storage and Preparation
 # @date: 11/2021
-# Merge two lists of dicts by key(s)
+# Merge (outer join) of dicts from several inputs by key(s)
 
-def mergeListsByKey(l1, l2, key):
-    """Merge two lists by key value
-        Usage:
-            l3 = [{**i1, **i2} for i1, i2 in mergeListsByKey(l1, l2, key="key")]"""
-
-    # Sort by key
-    l1 = iter(sorted(l1, key=lambda x: x[key]))
-    l2 = iter(sorted(l2, key=lambda x: x[key]))
-
-    # Create fill values
-    i1 = next(l1, None)
-    f1 = i1.copy()
-    f1.pop(key, None)
-    f1 = dict.fromkeys(f1, None)
-
-    i2 = next(l2, None)
-    f2 = i2.copy()
-    f2.pop(key, None)
-    f2 = dict.fromkeys(f2, None)
-
-    # Iterate and merge
-    while (i1 is not None) or (i2 is not None):
-        if i1 is None:
-            yield f1, i2
-            i2 = next(l2, None)
-        elif i2 is None:
-            yield i1, f2
-            i2 = next(l1, None)
-        elif i1.get(key) == i2.get(key):
-            yield i1, i2
-            i1 = next(l1, None)
-            i2 = next(l2, None)
-        elif i1.get(key) < i2.get(key):
-            yield i1, f2
-            i1 = next(l1, None)
-        else:
-            yield f1, i2
-            i2 = next(l2, None)
-
-def mergeListsByTwoKeys(l1, l2, key1, key2):
-    """Merge two lists by key value
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+
+from .extsort import external_sorted, DEFAULT_MEMORY_BUDGET
+
+Key = Union[str, Tuple[str, ...]]
+
+class MergeJoinError(Exception):
+    def __init__(self, message: str = ''):
+        super().__init__(message)
+
+def key_getter(key: Key) -> Callable[[dict], tuple]:
+    fields = (key,) if isinstance(key, str) else tuple(key)
+    return lambda x: tuple([x[field] for field in fields])
+
+def key_fields(key: Key) -> Tuple[str, ...]:
+    return (key,) if isinstance(key, str) else tuple(key)
+
+def merge_join(*inputs: Iterable[dict], key: Key, presorted: bool = True, memory_budget: Union[int, None] = DEFAULT_MEMORY_BUDGET) -> Iterator[dict]:
+    """Full outer join of inputs sorted by key, records are streamed and merged in one pass
+        Fields of later inputs override earlier ones, inputs without a record for the key contribute None values
+        Inputs that are not sorted are sorted first when presorted is False (externally when larger than memory_budget bytes),
+        out of order input raises MergeJoinError
         Usage:
-            l3 = [{**i1, **i2} for i1, i2 in mergeListsByKey(l1, l2, key1="key1", key2="key2")]"""
-
-    # Sort by key
-    l1 = iter(sorted(l1, key=lambda x: (x[key1], x[key2])))
-    l2 = iter(sorted(l2, key=lambda x: (x[key1], x[key2])))
-
-    # Create fill values
-    i1 = next(l1, None)
-    f1 = i1.copy()
-    f1.pop(key1, None)
-    f1.pop(key2, None)
-    f1 = dict.fromkeys(f1, None)
-
-    i2 = next(l2, None)
-    f2 = i2.copy()
-    f2.pop(key1, None)
-    f2.pop(key2, None)
-    f2 = dict.fromkeys(f2, None)
-
-    # Iterate and merge
-    while (i1 is not None) or (i2 is not None):
-        if i1 is None:
-            yield f1, i2
-            i2 = next(l2, None)
-        elif i2 is None:
-            yield i1, f2
-            i2 = next(l1, None)
-        elif i1.get(key1) == i2.get(key1):
-            if i1.get(key2) == i2.get(key2):
-                yield i1, i2
-                i1 = next(l1, None)
-                i2 = next(l2, None)
-            elif i1.get(key2) < i2.get(key2):
-                yield i1, f2
-                i1 = next(l1, None)
-            else:
-                yield f1, i2
-                i2 = next(l2, None)
-        elif i1.get(key1) < i2.get(key1):
-            yield i1, f2
-            i1 = next(l1, None)
-        else:
-            yield f1, i2
-            i2 = next(l2, None)
+            l3 = list(merge_join(l1, l2, l3, key=("datum", "kraj_nuts_kod")))"""
+
+    get_key = key_getter(key)
+    fields = key_fields(key)
+
+    if presorted:
+        iters = [iter(i) for i in inputs]
+    else:
+        iters = [external_sorted(i, get_key, memory_budget) for i in inputs]
+
+    # current record, its key and fill values for each input
+    current: List[Union[dict, None]] = [next(i, None) for i in iters]
+    keys = [get_key(x) if x is not None else None for x in current]
+    fills = [dict.fromkeys((f for f in x if f not in fields), None) if x is not None else {} for x in current]
+
+    while True:
+        active = [k for k in keys if k is not None]
+        if not active:
+            return
+
+        key_min = min(active)
+
+        merged = {}
+        for pos, record in enumerate(current):
+            if keys[pos] != key_min:
+                merged.update(fills[pos])
+                continue
+
+            merged.update(record)
+
+            current[pos] = next(iters[pos], None)
+            keys[pos] = get_key(current[pos]) if current[pos] is not None else None
+            if keys[pos] is not None and keys[pos] < key_min:
+                raise MergeJoinError('Input %i is not sorted by %s (%s after %s)' % (pos, ', '.join(fields), keys[pos], key_min))
+
+        merged.update(zip(fields, key_min))
+        yield merged
+
+def hash_join(*inputs: Iterable[dict], key: Key, sort: bool = True) -> Iterator[dict]:
+    """Full outer join of unsorted inputs, records are merged in a dict indexed by key
+        Same semantics as merge_join, duplicate keys of one input are merged into a single record"""
+
+    get_key = key_getter(key)
+    fields = key_fields(key)
+
+    groups: Dict[tuple, List[Union[dict, None]]] = {}
+    fills: List[dict] = []
+    for pos, records in enumerate(inputs):
+        fill = None
+        for record in records:
+            if fill is None:
+                fill = dict.fromkeys((f for f in record if f not in fields), None)
+
+            record_key = get_key(record)
+            group = groups.get(record_key)
+            if group is None:
+                group = groups[record_key] = [None] * len(inputs)
+
+            group[pos] = record if group[pos] is None else {**group[pos], **record}
+
+        fills.append(fill if fill is not None else {})
+
+    keys = sorted(groups) if sort else groups.keys()
+    for record_key in keys:
+        merged = {}
+        for pos, record in enumerate(groups[record_key]):
+            merged.update(record if record is not None else fills[pos])
+
+        merged.update(zip(fields, record_key))
+        yield merged
@@ -0,0 +1,73 @@
+##
+# @file pipeline.py
+# Subject: UPA - Data Storage and Preparation
+# @date: 10/2026
+# Stages of the ingest running in threads connected by bounded queues
+
+import threading
+
+from queue import Queue, Full
+from typing import Iterable, Iterator, TypeVar
+
+from .jsonstream import batched
+
+T = TypeVar('T')
+
+# batches waiting between two stages, a full queue blocks the producing stage
+DEFAULT_QUEUE_SIZE = 8
+DEFAULT_BATCH_SIZE = 1000
+
+# how often a blocked producer checks whether the consumer stopped (s)
+PUT_TIMEOUT = 0.1
+
+class _Failure:
+    def __init__(self, exc: BaseException) -> None:
+        self.exc = exc
+
+_END = object()
+
+def pipelined(iterable: Iterable[T], queue_size: int = DEFAULT_QUEUE_SIZE, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[T]:
+    """Items of iterable produced by a background thread, so that producing the next items overlaps with consuming the previous ones
+        Items are passed in batches through a queue of queue_size batches, the producer waits when the consumer falls behind
+        An exception of the producer is raised in the consumer, closing the iterator stops the producer
+        Usage:
+            records = pipelined(read_json_data('kraj-okres-nakazeni.json')) # parsing stage
+            documents = pipelined(map(transform, records)) # transform stage
+            writer.write(documents) # insert stage in the current thread"""
+    queue = Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=PUT_TIMEOUT)
+                return True
+            except Full:
+                continue
+
+        return False
+
+    def produce() -> None:
+        try:
+            for batch in batched(iterable, batch_size):
+                if not put(batch):
+                    return
+            put(_END)
+        except BaseException as exc:
+            put(_Failure(exc))
+
+    thread = threading.Thread(target=produce, name='pipeline', daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.exc
+
+            yield from item
+    finally:
+        stop.set()
+        thread.join()
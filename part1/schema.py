@@ -0,0 +1,138 @@
+##
+# @file schema.py
+# Subject: UPA - Data Storage and Preparation
+# @date: 10/2026
+# Declarative mapping of dataset records to documents
+
+import hashlib
+import inspect
+
+from typing import Any, Callable, Dict, Iterable, List, Union
+
+class SchemaError(Exception):
+    def __init__(self, message: str = ''):
+        super().__init__(message)
+
+def int_or_none(value: str) -> Union[int, None]:
+    """Integer from a CSV column, None for an empty value"""
+    return int(value) if value else None
+
+def int_or_empty(value: str) -> Union[int, str]:
+    """Integer from a CSV column, empty values are kept (e.g. total over all pohlavi_kod)"""
+    return int(value) if value else ''
+
+def describe_converter(converter: Union[Callable[[Any], Any], None]) -> Union[str, None]:
+    """Qualified name and code of the converter, builtins (e.g. int) by name"""
+    if converter is None:
+        return None
+
+    name = '%s.%s' % (getattr(converter, '__module__', None), getattr(converter, '__qualname__', repr(converter)))
+    try:
+        return name + '\n' + inspect.getsource(converter)
+    except (OSError, TypeError):
+        return name
+
+class Field:
+    """Source field of a record copied to a target field of the document
+        converter is applied to values that are not None, required fields raise KeyError when missing in the record
+        Without keep_null the target field is left out of the document when the value is None"""
+
+    def __init__(
+        self,
+        source: str,
+        target: Union[str, None] = None,
+        converter: Union[Callable[[Any], Any], None] = None,
+        keep_null: bool = True,
+        required: bool = False
+    ) -> None:
+        self.source = source
+        self.target = target if target is not None else source
+        self.converter = converter
+        self.keep_null = keep_null
+        self.required = required
+
+def nullable(*sources: str) -> List[Field]:
+    """Fields copied unchanged, None when missing in the record"""
+    return [Field(source) for source in sources]
+
+def optional(*sources: str) -> List[Field]:
+    """Fields copied unchanged, left out of the document when missing in the record or None"""
+    return [Field(source, keep_null=False) for source in sources]
+
+class Schema:
+    """Fields of the documents of a collection, compiled to a function creating the document from a record
+        The same schema is used for JSON records and CSV rows (dicts of column values)
+        Usage:
+            schema = Schema([Field('datum', converter=parse_date, required=True), Field('vek')])
+            transform = schema.project(['datum']).compile()
+            documents = (transform(data) for data in read_json_data('kraj-okres-nakazeni.json'))"""
+
+    def __init__(self, fields: List[Field]) -> None:
+        targets = [field.target for field in fields]
+        if len(set(targets)) != len(targets):
+            raise SchemaError('Duplicate target fields in schema (%s)' % ', '.join(targets))
+
+        self.fields = fields
+
+    @property
+    def sources(self) -> List[str]:
+        """Source fields used by the schema, other fields of the records do not have to be read"""
+        return list(dict.fromkeys(field.source for field in self.fields))
+
+    @property
+    def targets(self) -> List[str]:
+        return [field.target for field in self.fields]
+
+    def project(self, targets: Union[Iterable[str], None]) -> 'Schema':
+        """Schema with only the given target fields (all fields for None), required fields are always kept"""
+        if targets is None:
+            return self
+
+        targets = set(targets)
+        unknown = targets.difference(self.targets)
+        if unknown:
+            raise SchemaError('Unknown fields in projection (%s)' % ', '.join(sorted(unknown)))
+
+        return Schema([field for field in self.fields if field.required or field.target in targets])
+
+    def fingerprint(self) -> str:
+        """Hash of the field definitions including the code of the converters, changes when the documents would be created differently"""
+        description = [
+            (field.source, field.target, describe_converter(field.converter), field.keep_null, field.required)
+            for field in self.fields
+        ]
+        return hashlib.sha256(repr(description).encode('utf-8')).hexdigest()
+
+    def compile(self) -> Callable[[dict], dict]:
+        """Generate the transformation as a single function, fields kept when null form one dict literal"""
+        namespace: Dict[str, Any] = {}
+        items = []
+        optional = []
+
+        for i, field in enumerate(self.fields):
+            if field.required:
+                value = 'data[%r]' % field.source
+                if field.converter is not None:
+                    namespace['c%i' % i] = field.converter
+                    value = 'c%i(%s)' % (i, value)
+            else:
+                value = 'data.get(%r)' % field.source
+                if field.converter is not None:
+                    # converters are not called for missing values
+                    namespace['c%i' % i] = lambda value, converter=field.converter: None if value is None else converter(value)
+                    value = 'c%i(%s)' % (i, value)
+
+            if field.keep_null or field.required:
+                items.append('%r: %s' % (field.target, value))
+            else:
+                optional.append((field.target, value))
+
+        lines = ['def transform(data):', '    doc = {%s}' % ', '.join(items)]
+        for target, value in optional:
+            lines.append('    value = %s' % value)
+            lines.append('    if value is not None:')
+            lines.append('        doc[%r] = value' % target)
+        lines.append('    return doc')
+
+        exec('\n'.join(lines), namespace)
+        return namespace['transform']
@@ -7,22 +7,66 @@
 
 import argparse
 import sys
+import time
 
-from part1.download import download_data
+from part1.download import download_data, DownloadError, DEFAULT_WORKERS, DEFAULT_PER_HOST
+from part1.dataset import SUFFIXES
 from part1.db import DBC
+from part1.extsort import DEFAULT_MEMORY_BUDGET
+from part1.jsonchunks import BACKENDS
 
 def main() -> None:
     argparser = argparse.ArgumentParser()
     argparser.add_argument('-H', '--host', dest='host', help='DB server host', default=DBC.DEFAULT_HOST, type=str, required=False)
     argparser.add_argument('-p', '--port', dest='port', help='DB server port number', default=DBC.DEFAULT_PORT, type=int, required=False)
     argparser.add_argument('-t', '--timeout', dest='timeout', help='timeout for server connection', default=None, type=int, required=False)
+    argparser.add_argument('-w', '--workers', dest='workers', help='number of concurrent downloads', default=DEFAULT_WORKERS, type=int, required=False)
+    argparser.add_argument('--per-host', dest='per_host', help='maximum concurrent downloads from a single host', default=DEFAULT_PER_HOST, type=int, required=False)
+    argparser.add_argument('-c', '--compress', dest='compression', help='store large raw datasets compressed', default=None, choices=list(SUFFIXES), required=False)
+    argparser.add_argument('-b', '--batch-size', dest='batch_size', help='documents per insert (adaptive by default)', default=None, type=int, required=False)
+    argparser.add_argument('--bypass-validation', dest='bypass_validation', help='bypass document validation on insert', action='store_true', required=False)
+    argparser.add_argument('-j', '--jobs', dest='jobs', help='number of collections created in parallel', default=1, type=int, required=False)
+    argparser.add_argument('-m', '--memory-budget', dest='memory_budget', help='memory for sorting and grouping before spilling to disk (MB)', default=None, type=int, required=False)
+    argparser.add_argument('-s', '--staging', dest='staging', help='rebuild collections in staging collections and swap them in when ready', action='store_true', required=False)
+    argparser.add_argument('--histograms', dest='histograms', help='store per person collections as histograms with pocet (add - next to the raw collections, replace - instead of them)', default='off', choices=DBC.HISTOGRAMS, required=False)
+    argparser.add_argument('--buckets', dest='buckets', help='store ORP daily data also in monthly buckets (time series collections with MongoDB 5)', action='store_true', required=False)
+    argparser.add_argument('--projection', dest='projections', help='store only the given fields of a collection (collection=field,field,...), can be repeated', action='append', default=[], type=str, required=False)
+    argparser.add_argument('-e', '--encoders', dest='encoders', help='number of processes creating documents and encoding them to BSON for a collection', default=1, type=int, required=False)
+    argparser.add_argument('-u', '--update', dest='update', help='rebuild only the collections whose source datasets or builders changed since the last build', action='store_true', required=False)
+    argparser.add_argument('-d', '--delta', dest='delta', help='ingest only recent days of the daily series (from the stored watermark), rebuild changed collections', action='store_true', required=False)
+    argparser.add_argument('--delta-days', dest='delta_days', help='days before the watermark replaced by delta ingestion', default=DBC.DEFAULT_DELTA_DAYS, type=int, required=False)
+    argparser.add_argument('-r', '--resume', dest='checkpoints', help='record checkpoints of the inserted chunks, a rerun keeps completed collections and resumes interrupted ones', action='store_true', required=False)
+    argparser.add_argument('--pipeline', dest='pipeline', help='parse, create and insert documents concurrently in threads connected by bounded queues', action='store_true', required=False)
+    argparser.add_argument('--json-workers', dest='json_workers', help='processes decoding chunks of JSON datasets (and creating documents of the per person collections)', default=1, type=int, required=False)
+    argparser.add_argument('--json-backend', dest='json_backend', help='JSON decoder of the chunks (orjson when installed by default)', default=None, choices=BACKENDS, required=False)
+    argparser.add_argument('-f', '--force', dest='force', help='download all datasets even when they were not modified', action='store_true', required=False)
 
     args, _ = argparser.parse_known_args(sys.argv)
 
-    download_data(rewrite=True)
+    projections = {}
+    for projection in args.projections:
+        name, sep, fields = projection.partition('=')
+        if not sep:
+            argparser.error('argument --projection: expected collection=field,... (got %s)' % projection)
+        projections[name] = [field for field in fields.split(',') if field]
 
-    dbc = DBC(args.host, args.port, args.timeout)
-    dbc.create_all_collections()
+    start = time.perf_counter()
+    try:
+        total = download_data(rewrite=True, workers=args.workers, per_host=args.per_host, force=args.force, compression=args.compression)
+    except DownloadError as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+    print('Download finished in %.1f s (sequential %.1f s, saved %.1f s)' % (elapsed, total, max(total - elapsed, 0.0)))
+
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget is not None else DEFAULT_MEMORY_BUDGET
+    dbc = DBC(args.host, args.port, args.timeout, args.batch_size, args.bypass_validation, log=True, memory_budget=memory_budget, staging=args.staging, histograms=args.histograms, buckets=args.buckets, projections=projections, encoders=args.encoders, delta_days=args.delta_days, checkpoints=args.checkpoints, pipeline=args.pipeline, json_workers=args.json_workers, json_backend=args.json_backend)
+    if args.delta:
+        dbc.append_collections(workers=args.jobs)
+    elif args.update:
+        dbc.update_collections(workers=args.jobs)
+    else:
+        dbc.create_all_collections(workers=args.jobs)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,158 @@
+##
+# @file test_download.py
+# Subject: UPA - Data Storage and Preparation
+# @date: 10/2026
+# Downloads against a local stub HTTP server
+
+import http.server
+import inspect
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+
+from typing import List
+from unittest import mock
+from urllib3.connectionpool import HTTPConnectionPool
+
+from part1 import download
+from part1.download import DownloadError
+
+BODY = bytes(range(256)) * 64
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """Replies with the next scripted response of the server, the last one is repeated
+        A response is a status, 'cut' (half of the body and a closed connection) or 'ok' (whole body or the requested range)"""
+
+    def do_GET(self) -> None:
+        server = self.server
+        server.requests.append(dict(self.headers))
+        reply = server.script[min(len(server.requests), len(server.script)) - 1]
+
+        if isinstance(reply, int):
+            self.send_response(reply)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start = 0
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if match is not None and self.headers.get('If-Range') == server.etag:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %i-%i/%i' % (start, len(server.body) - 1, len(server.body)))
+        else:
+            self.send_response(200)
+
+        body = server.body[start:]
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if reply == 'cut':
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.requests = []
+        self.server.script = ['ok']
+        self.server.body = BODY
+        self.server.etag = '"v1"'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.url = 'http://127.0.0.1:%i/data.json' % self.server.server_address[1]
+        self.path = tempfile.mkdtemp()
+        # small chunks, so that a part of the cut body is written to the partial file
+        for name, value in (('DATA_PATH', self.path), ('CHUNK_SIZE', 1024)):
+            patcher = mock.patch.object(download, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def run_download(self, script: List, retries: int = 3) -> None:
+        self.server.script = script
+        download.download(self.url, 'data.json', rewrite=True, log=False, retries=retries, backoff=0.0)
+
+    def read_file(self) -> bytes:
+        with open(os.path.join(self.path, 'data.json'), 'rb') as file:
+            return file.read()
+
+    def test_download(self) -> None:
+        self.run_download(['ok'])
+        self.assertEqual(self.read_file(), BODY)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_transient_error_retried_once_per_attempt(self) -> None:
+        self.run_download([503, 503, 'ok'])
+        self.assertEqual(self.read_file(), BODY)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retries_exhausted(self) -> None:
+        with self.assertRaises(DownloadError) as ctx:
+            self.run_download([503], retries=2)
+        self.assertEqual(ctx.exception.status, 503)
+        # one retry layer, the initial request and two retries
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_client_error_not_retried(self) -> None:
+        with self.assertRaises(DownloadError) as ctx:
+            self.run_download([404])
+        self.assertEqual(ctx.exception.status, 404)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_interrupted_transfer_resumed(self) -> None:
+        self.run_download(['cut', 'ok'])
+        self.assertEqual(self.read_file(), BODY)
+        self.assertRegex(self.server.requests[1].get('Range', ''), r'^bytes=[1-9]\d*-$')
+        self.assertEqual(self.server.requests[1]['If-Range'], '"v1"')
+
+    def test_short_body_resumed(self) -> None:
+        # like urllib3 1.x, a connection closed before Content-Length is not an error of the response
+        make_request = HTTPConnectionPool._make_request
+        if 'enforce_content_length' in inspect.signature(make_request).parameters:
+            lenient = lambda pool, *args, **kwargs: make_request(pool, *args, **{**kwargs, 'enforce_content_length': False})
+            patcher = mock.patch.object(HTTPConnectionPool, '_make_request', lenient)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with self.assertRaises(DownloadError) as ctx:
+            self.run_download(['cut'], retries=0)
+        # reported by the length check, not by urllib3
+        self.assertIsInstance(ctx.exception.__cause__, DownloadError)
+        self.assertTrue(ctx.exception.__cause__.transient)
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'data.json')))
+        self.assertTrue(os.path.isfile(os.path.join(self.path, 'data.json' + download.PARTIAL_SUFFIX)))
+
+        self.run_download(['ok'])
+        self.assertEqual(self.read_file(), BODY)
+        self.assertRegex(self.server.requests[1].get('Range', ''), r'^bytes=[1-9]\d*-$')
+
+    def test_changed_dataset_restarted(self) -> None:
+        self.server.script = ['cut']
+        with self.assertRaises(DownloadError):
+            download.download(self.url, 'data.json', rewrite=True, log=False, retries=0, backoff=0.0)
+
+        self.server.body = BODY[::-1]
+        self.server.etag = '"v2"'
+        self.run_download(['ok'])
+        self.assertEqual(self.read_file(), BODY[::-1])
+
+if __name__ == '__main__':
+    unittest.main()
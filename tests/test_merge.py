@@ -0,0 +1,40 @@
+##
+# @file test_merge.py
+# Subject: UPA - Data Storage and Preparation
+# @date: 10/2026
+# Outer joins of sorted and unsorted inputs
+
+import random
+import unittest
+
+from part1.merge import MergeJoinError, hash_join, merge_join
+
+def series(days: range, field: str) -> list:
+    return [{'datum': day, 'kraj': day % 3, field: day * 10} for day in days]
+
+class JoinTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.inputs = [series(range(0, 20), 'a'), series(range(5, 30, 2), 'b'), series(range(10, 12), 'c')]
+        self.key = ('datum', 'kraj')
+
+    def test_merge_join(self) -> None:
+        joined = list(merge_join(*self.inputs, key=self.key))
+        self.assertEqual([record['datum'] for record in joined], list(range(0, 20)) + list(range(21, 30, 2)))
+        self.assertEqual(joined[0], {'datum': 0, 'kraj': 0, 'a': 0, 'b': None, 'c': None})
+        self.assertEqual(joined[10], {'datum': 10, 'kraj': 1, 'a': 100, 'b': None, 'c': 100})
+
+    def test_hash_join_same_as_merge_join(self) -> None:
+        shuffled = [random.Random(1).sample(records, len(records)) for records in self.inputs]
+        self.assertEqual(list(hash_join(*shuffled, key=self.key)), list(merge_join(*self.inputs, key=self.key)))
+
+    def test_unsorted_input_rejected(self) -> None:
+        with self.assertRaises(MergeJoinError):
+            list(merge_join(list(reversed(self.inputs[0])), key=self.key))
+
+    def test_unsorted_input_sorted(self) -> None:
+        reversed_inputs = [list(reversed(records)) for records in self.inputs]
+        joined = merge_join(*reversed_inputs, key=self.key, presorted=False, memory_budget=None)
+        self.assertEqual(list(joined), list(merge_join(*self.inputs, key=self.key)))
+
+if __name__ == '__main__':
+    unittest.main()